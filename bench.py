@@ -0,0 +1,197 @@
+# Офлайн-бенчмарк горячих обработчиков bot.py на поддельном Bot API (fake_bot_api.py).
+# Настоящий Telegram и настоящий bot.db не используются.
+#
+# Пример:
+#   python bench.py --latency-ms 50 --campaigns 1,5,15 --users 10,1000 --requests 200 --broadcast 100,1000
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import warnings
+
+import bot
+from fake_bot_api import BOT_USER, FakeBotAPI, FakeRequest
+from telegram import Update
+from telegram.ext import CallbackContext
+from telegram.warnings import PTBUserWarning
+
+ADMIN_ID = next(iter(bot.ADMIN_USER_IDS))
+FIRST_USER_ID = 1_000_000
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def user_json(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user_json(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_json(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "…",
+            },
+        },
+    }
+
+def reset_caches():
+    bot.membership_cache.clear()
+    bot.membership_index.clear()
+    bot.chat_info_cache.invalidate()
+    bot.recent_subscription_checks.clear()
+
+def setup_campaigns(count: int):
+    bot.active_campaigns.clear()
+    for i in range(count):
+        chat_id = -1001000000000 - i
+        bot.active_campaigns[chat_id] = {
+            'link': f"https://t.me/bench_channel_{i}",
+            'expires_at': None,
+            'member_limit': None,
+            'start_time': bot.datetime.now(),
+        }
+    reset_caches()
+
+handler_errors = []
+
+async def count_handler_error(update: object, context: CallbackContext):
+    # Смоделированные ошибки API долетают до обработчика ошибок — считаем их вместо трейсбеков в логе
+    handler_errors.append(type(context.error).__name__)
+
+def report(name: str, params: str, latencies: list, api_calls: int):
+    print(
+        f"{name:<20} {params:<24} n={len(latencies):<5} "
+        f"p50={percentile(latencies, 50) * 1000:8.1f}мс p95={percentile(latencies, 95) * 1000:8.1f}мс "
+        f"p99={percentile(latencies, 99) * 1000:8.1f}мс api/upd={api_calls / max(1, len(latencies)):6.2f} "
+        f"ошибок={len(handler_errors)}"
+    )
+    handler_errors.clear()
+
+async def bench_updates(app, api: FakeBotAPI, make_update, requests: int, users: int) -> tuple:
+    latencies = []
+    api.reset_counters()
+    for i in range(requests):
+        user_id = FIRST_USER_ID + i % users
+        update = Update.de_json(make_update(i + 1, user_id), app.bot)
+        started = time.perf_counter()
+        await app.process_update(update)
+        latencies.append(time.perf_counter() - started)
+    return latencies, api.total_calls
+
+async def bench_status(app, api: FakeBotAPI, requests: int) -> tuple:
+    latencies = []
+    api.reset_counters()
+    context = CallbackContext(app)
+    for _ in range(requests):
+        bot.chat_info_cache.invalidate()
+        started = time.perf_counter()
+        await bot.generate_human_readable_status(context)
+        latencies.append(time.perf_counter() - started)
+    return latencies, api.total_calls
+
+async def bench_broadcast(app, api: FakeBotAPI, size: int) -> tuple:
+    for i in range(size):
+        bot.users.touch(FIRST_USER_ID + i)
+    await app.process_update(Update.de_json(callback_update(1, ADMIN_ID, "admin_broadcast"), app.bot))
+    api.reset_counters()
+    started = time.perf_counter()
+    await app.process_update(Update.de_json(message_update(2, ADMIN_ID, "Бенчмарк рассылки"), app.bot))
+    while bot.active_broadcasts:
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started, api.total_calls
+
+async def run(args):
+    api = FakeBotAPI(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+        retry_after_rate=args.retry_after_rate, subscribed_rate=args.subscribed_rate, seed=1
+    )
+    app = bot.build_application(request=FakeRequest(api))
+    app.add_error_handler(count_handler_error)
+    await app.initialize()
+    try:
+        print(
+            f"# задержка API {args.latency_ms}±{args.jitter_ms}мс, ошибки {args.error_rate:.1%}, "
+            f"RetryAfter {args.retry_after_rate:.1%}, подписаны {args.subscribed_rate:.0%}"
+        )
+        for campaigns in args.campaigns:
+            setup_campaigns(campaigns)
+            for users in args.users:
+                params = f"campaigns={campaigns} users={users}"
+                reset_caches()
+                latencies, calls = await bench_updates(
+                    app, api, lambda i, uid: message_update(i, uid, "/start"), args.requests, users
+                )
+                report("start_with_code", params, latencies, calls)
+                reset_caches()
+                latencies, calls = await bench_updates(
+                    app, api, lambda i, uid: callback_update(i, uid, "check_sub"), args.requests, users
+                )
+                report("button_handler", params, latencies, calls)
+            latencies, calls = await bench_status(app, api, args.requests)
+            report("status", f"campaigns={campaigns}", latencies, calls)
+        setup_campaigns(0)
+        bot.BROADCAST_PROGRESS_INTERVAL = 3600
+        bot.broadcast_limiter = bot.BroadcastRateLimiter(args.broadcast_rate, bot.BROADCAST_PER_CHAT_RATE)
+        for size in args.broadcast:
+            elapsed, calls = await bench_broadcast(app, api, size)
+            print(
+                f"{'broadcast':<20} {f'recipients={size}':<24} {elapsed:8.2f}с "
+                f"{size / elapsed:8.1f} сообщ./с api={calls}"
+            )
+    finally:
+        await app.shutdown()
+
+def int_list(value: str) -> list:
+    return [int(part) for part in value.split(",") if part]
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков на поддельном Bot API")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--subscribed-rate", type=float, default=0.9)
+    parser.add_argument("--campaigns", type=int_list, default=[1, 5, bot.MAX_CAMPAIGNS])
+    parser.add_argument("--users", type=int_list, default=[10, 1000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--broadcast", type=int_list, default=[100, 1000])
+    parser.add_argument("--broadcast-rate", type=float, default=1000,
+                        help="лимит сообщений в секунду (у Telegram ~30, выше — чтобы мерить сам движок)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    # Рассылка запускается через create_task без run_polling — здесь это ожидаемо
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    bot.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bot.db")
+    # Бенчмарк нарочно долбит обработчики одними и теми же пользователями — антифлуд здесь только мешает
+    bot.user_throttle = bot.UserThrottle(1e9, 1e9, bot.USER_THROTTLE_MAX_USERS)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
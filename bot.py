@@ -1,28 +1,1387 @@
+import asyncio
+import atexit
+import bisect
+import contextvars
+import functools
+import heapq
+import html
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import re
-import random
+import secrets
+import signal
+import sqlite3
 import string
+import threading
+import time
+import urllib.parse
+from array import array
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from telegram.error import BadRequest
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+)
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes,
+    MessageHandler, filters
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 
 # === НАСТРОЙКИ ===
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-
 ADMIN_USER_IDS = {8523456846, 5870949629}
 MAX_CAMPAIGNS = 15
 MAX_MEMBER_LIMIT = 50000
 BOT_USERNAME = "EpiLink_Bot"
+TOKEN = "8584027906:AAEZvDcBZw-ugYDOKT6yOurh6vSS5fljpTY"
+# Адрес Bot API; можно указать локальный telegram-bot-api сервер
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+
+# Режим получения апдейтов: "polling" (getUpdates) или "webhook" (встроенный сервер python-telegram-bot)
+RUN_MODE = os.environ.get("BOT_RUN_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("BOT_WEBHOOK_PATH", "telegram")
+# Публичный https-адрес вебхука; без него можно работать только с локальным Bot API сервером
+WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL")
+WEBHOOK_SECRET_TOKEN = os.environ.get("BOT_WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("BOT_WEBHOOK_MAX_CONNECTIONS", "100"))
+
+# Пул соединений к Bot API и сколько секунд ждать свободного соединения (потом — TimedOut)
+HTTP_POOL_SIZE = 256
+HTTP_POOL_TIMEOUT = 5.0
+# Сколько апдейтов обрабатывается одновременно; апдейты одного пользователя всё равно идут по очереди
+MAX_CONCURRENT_UPDATES = 64
+# Соединения под рассылку, пробы каналов и прочие фоновые задачи
+HTTP_POOL_RESERVE = 64
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.db")
+# Изменения пользователей, кампаний и ссылок копятся в памяти и пишутся в bot.db раз в столько секунд
+STORAGE_FLUSH_INTERVAL = 1.0
+# last_seen пользователя сохраняется не чаще, чем раз в столько секунд
+USER_LAST_SEEN_RESOLUTION = 60
+# Новые пользователи вливаются в отсортированный массив, когда их накопится столько (или 1/8 от всех)
+USER_REGISTRY_MERGE_THRESHOLD = 4096
+# Сохранённые ссылки: длина кода, сколько ссылок держать в памяти, как часто чистить истёкшие
+SAVED_LINK_CODE_LENGTH = 12
+SAVED_LINKS_CACHE_SIZE = 5000
+SAVED_LINKS_PURGE_INTERVAL = 3600
+# Имена пользователей для подстановки {first_name}: сколько последних держать в памяти
+USER_NAMES_CACHE_SIZE = 50000
+
+# Проверка подписки: сколько запросов get_chat_member выполняется одновременно во всём процессе
+# и сколько секунд ждать ответа по одному каналу. Вместе с ответами обработчиков (по одному
+# на апдейт) и фоновым резервом запросы помещаются в пул: если запросов больше, чем соединений,
+# httpcore тратит CPU на перебор очереди пула, и таймаутами заканчиваются уже ответы пользователям
+MEMBERSHIP_CHECK_CONCURRENCY = HTTP_POOL_SIZE - MAX_CONCURRENT_UPDATES - HTTP_POOL_RESERVE
+MEMBERSHIP_CHECK_TIMEOUT = 5.0
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+# Канал, по которому столько проверок подряд упали из-за доступа бота, исключается из проверки,
+# пока фоновая проба не увидит, что доступ вернулся (проба раз в 1 мин, с удвоением до 15 мин)
+CHANNEL_FAILURE_THRESHOLD = 5
+CHANNEL_PROBE_MIN_INTERVAL = 60
+CHANNEL_PROBE_MAX_INTERVAL = 900
+
+# Кэш статусов подписки (user_id, chat_id): подписка живёт дольше, отсутствие подписки — меньше
+MEMBERSHIP_CACHE_POSITIVE_TTL = 600
+MEMBERSHIP_CACHE_NEGATIVE_TTL = 20
+MEMBERSHIP_CACHE_MAX_SIZE = 100000
+# Индекс подписок из апдейтов chat_member: не больше стольких пользователей на канал (LRU)
+MEMBERSHIP_INDEX_MAX_PER_CHAT = 50000
+
+# Кэш данных каналов: название/username меняются редко, число участников — часто
+CHAT_INFO_TTL = 3600
+CHAT_MEMBERS_COUNT_TTL = 30
+
+# Адаптивный опрос числа участников для кампаний с лимитом (секунды):
+# следующий замер делается через долю прогнозного времени до лимита
+MEMBER_SAMPLE_MIN_INTERVAL = 10
+MEMBER_SAMPLE_MAX_INTERVAL = 900
+MEMBER_SAMPLE_ETA_FRACTION = 0.5
+MEMBER_SAMPLE_RATE_SMOOTHING = 0.5
+
+# Рассылка: общий лимит Telegram ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+BROADCAST_GLOBAL_RATE = 25
+BROADCAST_PER_CHAT_RATE = 1
+BROADCAST_CONCURRENCY = 20
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_NAMES_BATCH = 500
+# Части альбома приходят отдельными апдейтами: ждём столько секунд после последней части
+MEDIA_GROUP_DEBOUNCE = 1.0
+# Отметки о доставке пишутся в bot.db пачками раз в столько секунд
+BROADCAST_CHECKPOINT_INTERVAL = 2
+
+# Антифлуд для /start и «Проверить подписку»: в среднем запрос раз в 2 секунды, всплеск до 5
+USER_THROTTLE_RATE = 0.5
+USER_THROTTLE_BURST = 5
+USER_THROTTLE_MAX_USERS = 10000
+# Результат проверки подписки переиспользуется столько секунд (повторные нажатия, /start + меню)
+SUBSCRIPTION_CHECK_REUSE = 2.0
+
+# История числа участников: точек на кампанию, не чаще одной точки в минуту;
+# кампании без лимита опрашиваются раз в 5 минут только ради истории
+MEMBER_SERIES_CAPACITY = 360
+MEMBER_SERIES_MIN_SPACING = 60
+MEMBER_SERIES_INTERVAL = 300
+SPARKLINE_WIDTH = 16
+
+# Экран «Статус проверок» показывает столько кампаний на странице
+STATUS_PAGE_SIZE = 5
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Метрики в формате Prometheus на локальном порту (0 — не поднимать)
+METRICS_LISTEN = os.environ.get("BOT_METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", "9108"))
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Остановка: столько секунд даётся рассылкам и уведомлениям, чтобы дойти до контрольной точки
+# (по умолчанию с запасом до SIGKILL через 10 с у Docker/systemd)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("BOT_SHUTDOWN_TIMEOUT", "8"))
+
+# Логи: json (по строке JSON на запись) или text; одинаковые предупреждения — не больше
+# LOG_REPEAT_BURST раз за LOG_REPEAT_WINDOW секунд, остальные только подсчитываются
+LOG_FORMAT = os.environ.get("BOT_LOG_FORMAT", "json")
+LOG_LEVEL = os.environ.get("BOT_LOG_LEVEL", "INFO")
+LOG_REPEAT_BURST = 5
+LOG_REPEAT_WINDOW = 60
+
+# === ЛОГИРОВАНИЕ ===
+
+# Идентификатор апдейта, в обработке которого написана строка лога; задачи наследуют его через контекст
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            'level': record.levelname,
+            'logger': record.name,
+            'trace_id': getattr(record, 'trace_id', "-"),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RepeatFilter(logging.Filter):
+    # Одинаковые предупреждения (тот же логгер, уровень и текст) пропускаются пачкой в начале окна,
+    # дальше только считаются; первая запись следующего окна сообщает, сколько было подавлено
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._seen = {}  # (логгер, уровень, текст) -> [начало окна, записей в окне]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = record.created
+        entry = self._seen.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            suppressed = entry[1] - self.burst if entry and entry[1] > self.burst else 0
+            if len(self._seen) > 10000:
+                self._seen.clear()
+            self._seen[key] = [now, 1]
+            if suppressed:
+                record.msg = f"{record.getMessage()} (ещё {suppressed} таких же подавлено)"
+                record.args = None
+            return True
+        entry[1] += 1
+        return entry[1] <= self.burst
+
+class TracingQueueHandler(logging.handlers.QueueHandler):
+    # В потоке обработчика — только пометка trace id и put в очередь; форматирование и запись
+    # делает поток QueueListener. Запись в пределах процесса не копируется и не сериализуется
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.trace_id = trace_id_var.get()
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s"
+        ))
+    log_queue = queue.SimpleQueue()
+    handler = TracingQueueHandler(log_queue)
+    handler.addFilter(RepeatFilter(LOG_REPEAT_BURST, LOG_REPEAT_WINDOW))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при выходе, чтобы не потерять последние строки
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+# === БАЗА ДАННЫХ ===
+
+db_lock = threading.Lock()
+_db = None
+
+def get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                first_seen INTEGER NOT NULL DEFAULT 0,
+                last_seen INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS campaigns (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS saved_messages (
+                code TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS password_attempts (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS user_names (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS member_series (
+                chat_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                admin_chat_id INTEGER NOT NULL,
+                status_message_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID;
+        """)
+        ensure_columns(_db, 'users', {
+            'first_seen': "INTEGER NOT NULL DEFAULT 0",
+            'last_seen': "INTEGER NOT NULL DEFAULT 0",
+            'blocked': "INTEGER NOT NULL DEFAULT 0",
+        })
+        ensure_columns(_db, 'saved_messages', {
+            'created_at': "REAL NOT NULL DEFAULT 0",
+            'expires_at': "REAL",
+            'max_views': "INTEGER",
+            'views': "INTEGER NOT NULL DEFAULT 0",
+        })
+    return _db
+
+def ensure_columns(db: sqlite3.Connection, table: str, columns: dict):
+    # Добавляет колонки, которых не было в bot.db, созданной старой версией бота
+    existing = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+    for name, declaration in columns.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+    db.commit()
+
+# Статусы получателя рассылки
+RECIPIENT_PENDING, RECIPIENT_SENT, RECIPIENT_FAILED = 0, 1, 2
+
+def db_create_broadcast(payload: dict, admin_chat_id: int, status_message_id: int, recipients: list) -> int:
+    with db_lock:
+        db = get_db()
+        with db:
+            cursor = db.execute(
+                "INSERT INTO broadcast_jobs (payload, admin_chat_id, status_message_id, state, total, created_at) "
+                "VALUES (?, ?, ?, 'running', ?, ?)",
+                (json.dumps(payload), admin_chat_id, status_message_id, len(recipients), time.time())
+            )
+            job_id = cursor.lastrowid
+            db.executemany(
+                "INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id) VALUES (?, ?)",
+                ((job_id, user_id) for user_id in recipients)
+            )
+        return job_id
+
+def db_checkpoint_broadcast(job_id: int, deliveries: list, sent: int, failed: int):
+    with db_lock:
+        db = get_db()
+        with db:
+            db.executemany(
+                "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?",
+                ((status, job_id, user_id) for user_id, status in deliveries)
+            )
+            db.execute("UPDATE broadcast_jobs SET sent = ?, failed = ? WHERE id = ?", (sent, failed, job_id))
+
+def db_set_broadcast_state(job_id: int, state: str):
+    with db_lock:
+        db = get_db()
+        with db:
+            db.execute("UPDATE broadcast_jobs SET state = ? WHERE id = ?", (state, job_id))
+
+def db_checkpoint_wal():
+    # Переносим WAL в основной файл при остановке, чтобы следующий запуск не проигрывал его заново
+    with db_lock:
+        db = get_db()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("PRAGMA optimize")
+
+def db_load_unfinished_broadcasts() -> list:
+    with db_lock:
+        db = get_db()
+        jobs = []
+        rows = db.execute(
+            "SELECT id, payload, admin_chat_id, status_message_id, state, total, sent, failed "
+            "FROM broadcast_jobs WHERE state IN ('running', 'paused') ORDER BY id"
+        ).fetchall()
+        for job_id, payload, admin_chat_id, status_message_id, state, total, sent, failed in rows:
+            pending = [user_id for (user_id,) in db.execute(
+                "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = ?", (job_id, RECIPIENT_PENDING)
+            )]
+            jobs.append({
+                'id': job_id, 'payload': json.loads(payload), 'admin_chat_id': admin_chat_id,
+                'status_message_id': status_message_id, 'state': state, 'total': total,
+                'sent': sent, 'failed': failed, 'pending': pending
+            })
+        return jobs
+
+def db_load_first_names(user_ids: list) -> dict:
+    names = {}
+    with db_lock:
+        db = get_db()
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            rows = db.execute(
+                f"SELECT user_id, data FROM user_names WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            names.update(rows)
+    return names
+
+# === ХРАНИЛИЩЕ ===
+
+class Storage:
+    # Write-behind поверх bot.db: обработчики меняют только память,
+    # фоновый поток пачками переносит изменения в SQLite
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending = {}  # (таблица, ключ) -> значение или None для удаления; (таблица, '*') -> очистка
+        self._increments = {}  # (таблица, ключ, колонка) -> сколько прибавить
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def put(self, table: str, key, value):
+        with self._lock:
+            self._pending.pop((table, key), None)
+            self._pending[(table, key)] = value
+
+    def delete(self, table: str, key):
+        self.put(table, key, None)
+
+    def clear(self, table: str):
+        with self._lock:
+            for pending_key in [k for k in self._pending if k[0] == table]:
+                del self._pending[pending_key]
+            for pending_key in [k for k in self._increments if k[0] == table]:
+                del self._increments[pending_key]
+            self._pending[(table, '*')] = None
+
+    def increment(self, table: str, key, column: str, delta: int = 1):
+        # Счётчики копятся в памяти и уходят в базу одним UPDATE на ключ за сброс
+        with self._lock:
+            pending_key = (table, key, column)
+            self._increments[pending_key] = self._increments.get(pending_key, 0) + delta
+
+    def pending_increment(self, table: str, key, column: str) -> int:
+        with self._lock:
+            return self._increments.get((table, key, column), 0)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending and not self._increments:
+                return
+            pending, self._pending = self._pending, {}
+            increments, self._increments = self._increments, {}
+        try:
+            with db_lock:
+                db = get_db()
+                with db:
+                    for (table, key), value in pending.items():
+                        column = TABLE_KEYS[table]
+                        if key == '*':
+                            db.execute(f"DELETE FROM {table}")
+                        elif value is None:
+                            db.execute(f"DELETE FROM {table} WHERE {column} = ?", (key,))
+                        elif table == 'users':
+                            db.execute(
+                                "INSERT OR REPLACE INTO users (user_id, first_seen, last_seen, blocked) VALUES (?, ?, ?, ?)",
+                                (key, *value)
+                            )
+                        elif table == 'saved_messages':
+                            # Счётчик просмотров при перезаписи ссылки не сбрасывается
+                            db.execute(
+                                "INSERT INTO saved_messages (code, data, created_at, expires_at, max_views) "
+                                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(code) DO UPDATE SET data = excluded.data, "
+                                "created_at = excluded.created_at, expires_at = excluded.expires_at, "
+                                "max_views = excluded.max_views",
+                                (key, *value)
+                            )
+                        else:
+                            db.execute(f"INSERT OR REPLACE INTO {table} ({column}, data) VALUES (?, ?)", (key, value))
+                    for (table, key, column), delta in increments.items():
+                        db.execute(
+                            f"UPDATE {table} SET {column} = {column} + ? WHERE {TABLE_KEYS[table]} = ?", (delta, key)
+                        )
+        except Exception as e:
+            logging.error(f"Не удалось сохранить {len(pending) + len(increments)} изменений в bot.db: {e}")
+            with self._lock:
+                pending.update(self._pending)
+                self._pending = pending
+                for pending_key, delta in self._increments.items():
+                    increments[pending_key] = increments.get(pending_key, 0) + delta
+                self._increments = increments
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def load(self, table: str) -> list:
+        column = TABLE_KEYS[table]
+        with db_lock:
+            if table == 'users':
+                return get_db().execute(
+                    "SELECT user_id, first_seen, last_seen, blocked FROM users ORDER BY user_id"
+                ).fetchall()
+            return get_db().execute(f"SELECT {column}, data FROM {table}").fetchall()
+
+TABLE_KEYS = {
+    'users': 'user_id', 'campaigns': 'chat_id', 'saved_messages': 'code', 'password_attempts': 'user_id',
+    'member_series': 'chat_id', 'user_names': 'user_id',
+}
+CAMPAIGN_DATETIME_FIELDS = ('expires_at', 'start_time')
+
+def encode_campaign(data: dict) -> str:
+    return json.dumps({
+        key: value.isoformat() if key in CAMPAIGN_DATETIME_FIELDS and value else value
+        for key, value in data.items()
+    })
+
+def decode_campaign(raw: str) -> dict:
+    data = json.loads(raw)
+    for key in CAMPAIGN_DATETIME_FIELDS:
+        if data.get(key):
+            data[key] = datetime.fromisoformat(data[key])
+    return data
+
+class PersistentDict(dict):
+    def __init__(self, storage: Storage, table: str, encode=json.dumps, decode=json.loads):
+        super().__init__()
+        self.storage = storage
+        self.table = table
+        self.encode = encode
+        self.decode = decode
+        self.version = 0  # растёт при каждом изменении — по нему сбрасываются производные кэши
+
+    def load(self):
+        super().clear()
+        for key, raw in self.storage.load(self.table):
+            super().__setitem__(key, self.decode(raw))
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.storage.put(self.table, key, self.encode(value))
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.storage.delete(self.table, key)
+        self.version += 1
+
+    def pop(self, key, *default):
+        if key in self:
+            self.storage.delete(self.table, key)
+            self.version += 1
+        return super().pop(key, *default)
+
+    def clear(self):
+        super().clear()
+        self.storage.clear(self.table)
+        self.version += 1
+
+INVERTED_FLAGS = bytes([1]) + bytes(255)  # 0 -> 1, 1 -> 0 для bytearray.translate
+
+class UserRegistry:
+    # Отсортированный array('q') с id и колонки рядом с ним: first_seen/last_seen (unix-время, array('I'))
+    # и флаг blocked (bytearray) — около 17 байт на пользователя против ~70 у set из int.
+    # Новые пользователи копятся в небольшом словаре и пачками вливаются в массивы.
+    def __init__(self, storage: Storage, merge_threshold: int):
+        self.storage = storage
+        self.merge_threshold = merge_threshold
+        self._ids = array('q')
+        self._first_seen = array('I')
+        self._last_seen = array('I')
+        self._blocked = bytearray()
+        self._new = {}  # user_id -> [first_seen, last_seen, blocked]
+        self._blocked_count = 0
+
+    def load(self):
+        self._ids, self._first_seen, self._last_seen, self._blocked = array('q'), array('I'), array('I'), bytearray()
+        self._new = {}
+        for user_id, first_seen, last_seen, blocked in self.storage.load('users'):
+            self._ids.append(user_id)
+            self._first_seen.append(first_seen)
+            self._last_seen.append(last_seen)
+            self._blocked.append(blocked)
+        self._blocked_count = self._blocked.count(1)
+
+    def _index(self, user_id: int) -> int:
+        i = bisect.bisect_left(self._ids, user_id)
+        if i < len(self._ids) and self._ids[i] == user_id:
+            return i
+        return -1
+
+    def _merge(self):
+        ids, first_seen, last_seen, blocked = array('q'), array('I'), array('I'), bytearray()
+        start = 0
+        for user_id in sorted(self._new):
+            end = bisect.bisect_left(self._ids, user_id, start)
+            # Участки старых массивов копируются срезами, без цикла по каждому элементу
+            ids.extend(self._ids[start:end])
+            first_seen.extend(self._first_seen[start:end])
+            last_seen.extend(self._last_seen[start:end])
+            blocked.extend(self._blocked[start:end])
+            row = self._new[user_id]
+            ids.append(user_id)
+            first_seen.append(row[0])
+            last_seen.append(row[1])
+            blocked.append(row[2])
+            start = end
+        ids.extend(self._ids[start:])
+        first_seen.extend(self._first_seen[start:])
+        last_seen.extend(self._last_seen[start:])
+        blocked.extend(self._blocked[start:])
+        self._ids, self._first_seen, self._last_seen, self._blocked = ids, first_seen, last_seen, blocked
+        self._new = {}
+
+    def _save(self, user_id: int, first_seen: int, last_seen: int, blocked: int):
+        self.storage.put('users', user_id, (first_seen, last_seen, blocked))
+
+    def touch(self, user_id: int):
+        now = int(time.time())
+        i = self._index(user_id)
+        if i >= 0:
+            # Пользователь снова пишет боту, значит бот больше не заблокирован
+            if self._blocked[i]:
+                self._blocked[i] = 0
+                self._blocked_count -= 1
+            elif now - self._last_seen[i] < USER_LAST_SEEN_RESOLUTION:
+                return
+            self._last_seen[i] = now
+            self._save(user_id, self._first_seen[i], now, 0)
+            return
+        row = self._new.get(user_id)
+        if row is None:
+            row = self._new[user_id] = [now, now, 0]
+        else:
+            if row[2]:
+                row[2] = 0
+                self._blocked_count -= 1
+            elif now - row[1] < USER_LAST_SEEN_RESOLUTION:
+                return
+            row[1] = now
+        self._save(user_id, row[0], row[1], 0)
+        if len(self._new) >= max(self.merge_threshold, len(self._ids) // 8):
+            self._merge()
+
+    def mark_blocked(self, user_id: int):
+        i = self._index(user_id)
+        if i >= 0:
+            if not self._blocked[i]:
+                self._blocked[i] = 1
+                self._blocked_count += 1
+                self._save(user_id, self._first_seen[i], self._last_seen[i], 1)
+            return
+        row = self._new.get(user_id)
+        if row is not None and not row[2]:
+            row[2] = 1
+            self._blocked_count += 1
+            self._save(user_id, row[0], row[1], 1)
+
+    def active_ids(self):
+        # Id пользователей, которые не заблокировали бота, в порядке возрастания
+        if self._new:
+            self._merge()
+        return itertools.compress(self._ids, self._blocked.translate(INVERTED_FLAGS))
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._new or self._index(user_id) >= 0
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._new)
+
+    @property
+    def blocked_count(self) -> int:
+        return self._blocked_count
+
+    @property
+    def active_count(self) -> int:
+        return len(self) - self._blocked_count
+
+storage = Storage(STORAGE_FLUSH_INTERVAL)
+
+SAVED_LINK_ALPHABET = string.ascii_letters + string.digits
+
+class SavedLinkStore:
+    # Все ссылки лежат в bot.db, в памяти — LRU недавно открытых (и несуществующих) кодов
+    def __init__(self, storage: Storage, cache_size: int):
+        self.storage = storage
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # code -> {'data', 'created_at', 'expires_at', 'max_views', 'views'} или None, если кода нет
+        self._cache = OrderedDict()
+
+    def _remember(self, code: str, link):
+        self._cache[code] = link
+        self._cache.move_to_end(code)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _fetch(self, code: str):
+        with db_lock:
+            row = get_db().execute(
+                "SELECT data, created_at, expires_at, max_views, views FROM saved_messages WHERE code = ?", (code,)
+            ).fetchone()
+        if row is None:
+            return None
+        data, created_at, expires_at, max_views, views = row
+        # Просмотры, которые ещё не дошли до базы
+        views += self.storage.pending_increment('saved_messages', code, 'views')
+        return {
+            'data': json.loads(data), 'created_at': created_at, 'expires_at': expires_at,
+            'max_views': max_views, 'views': views,
+        }
+
+    @staticmethod
+    def is_exhausted(link: dict) -> bool:
+        if link['expires_at'] is not None and link['expires_at'] <= time.time():
+            return True
+        return link['max_views'] is not None and link['views'] >= link['max_views']
+
+    async def get(self, code: str):
+        if code in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(code)
+            link = self._cache[code]
+        else:
+            self.misses += 1
+            link = await asyncio.to_thread(self._fetch, code)
+            self._remember(code, link)
+        if link is None:
+            return None
+        if self.is_exhausted(link):
+            self.delete(code)
+            return None
+        return link
+
+    def put(self, code: str, data: dict, expires_at: float = None, max_views: int = None) -> dict:
+        link = {'data': data, 'created_at': time.time(), 'expires_at': expires_at, 'max_views': max_views, 'views': 0}
+        self._remember(code, link)
+        self.storage.put('saved_messages', code, (json.dumps(data), link['created_at'], expires_at, max_views))
+        return link
+
+    def delete(self, code: str):
+        self._remember(code, None)
+        self.storage.delete('saved_messages', code)
+
+    def register_view(self, code: str, link: dict):
+        link['views'] += 1
+        self.storage.increment('saved_messages', code, 'views')
+
+    def _code_exists(self, code: str) -> bool:
+        with db_lock:
+            return get_db().execute("SELECT 1 FROM saved_messages WHERE code = ?", (code,)).fetchone() is not None
+
+    async def create(self, data: dict, expires_at: float = None, max_views: int = None) -> str:
+        while True:
+            code = ''.join(secrets.choice(SAVED_LINK_ALPHABET) for _ in range(SAVED_LINK_CODE_LENGTH))
+            # Коды вида r<цифры> заняты персональными ссылками из рассылок
+            if REFERRAL_CODE_RE.match(code):
+                continue
+            if self._cache.get(code) is None and not await asyncio.to_thread(self._code_exists, code):
+                break
+        self.put(code, data, expires_at, max_views)
+        # Ссылку отдают админу сразу — она должна пережить падение бота в ту же секунду
+        await asyncio.to_thread(self.storage.flush)
+        return code
+
+    def count_links(self) -> tuple:
+        # (всего, с паролем) среди ещё действующих ссылок
+        with db_lock:
+            total, protected = get_db().execute(
+                "SELECT COUNT(*), COALESCE(SUM(json_extract(data, '$.password') IS NOT NULL), 0) FROM saved_messages "
+                "WHERE (expires_at IS NULL OR expires_at > ?) AND (max_views IS NULL OR views < max_views)",
+                (time.time(),)
+            ).fetchone()
+        return total, protected
+
+    async def stats(self) -> tuple:
+        # Сначала сбрасываем накопленные просмотры, иначе исчерпанные ссылки ещё посчитаются
+        await asyncio.to_thread(self.storage.flush)
+        return await asyncio.to_thread(self.count_links)
+
+    def _purge(self) -> int:
+        with db_lock:
+            db = get_db()
+            with db:
+                return db.execute(
+                    "DELETE FROM saved_messages WHERE (expires_at IS NOT NULL AND expires_at <= ?) "
+                    "OR (max_views IS NOT NULL AND views >= max_views)",
+                    (time.time(),)
+                ).rowcount
+
+    async def purge(self) -> int:
+        await asyncio.to_thread(self.storage.flush)
+        removed = await asyncio.to_thread(self._purge)
+        for code in [code for code, link in self._cache.items() if link is not None and self.is_exhausted(link)]:
+            self._cache[code] = None
+        return removed
+
+# Хранилища: чтение из памяти, запись через storage
+active_campaigns = PersistentDict(storage, 'campaigns', encode_campaign, decode_campaign)
+users = UserRegistry(storage, USER_REGISTRY_MERGE_THRESHOLD)
+saved_links = SavedLinkStore(storage, SAVED_LINKS_CACHE_SIZE)
+
+# Последние увиденные имена: в базу имя пишется, только когда его ещё нет в кэше или оно сменилось
+known_first_names = OrderedDict()  # user_id -> first_name
+
+def remember_first_name(user_id: int, first_name: str):
+    if known_first_names.get(user_id) == first_name:
+        known_first_names.move_to_end(user_id)
+        return
+    known_first_names[user_id] = first_name
+    known_first_names.move_to_end(user_id)
+    storage.put('user_names', user_id, first_name)
+    while len(known_first_names) > USER_NAMES_CACHE_SIZE:
+        known_first_names.popitem(last=False)
+
+user_password_attempts = PersistentDict(storage, 'password_attempts')  # user_id -> {'code': str, 'attempts': int}
+
+# === ИСТОРИЯ УЧАСТНИКОВ ===
+
+SPARKLINE_BARS = "▁▂▃▄▅▆▇█"
+
+class MemberSeries:
+    # Кольцевой буфер (время, число участников) плюс первая точка кампании — от неё считается прирост
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('I', bytes(4 * capacity))
+        self.counts = array('I', bytes(4 * capacity))
+        self.start = 0
+        self.size = 0
+        self.base = None  # (время, число участников) на старте кампании
+
+    def add(self, timestamp: int, count: int, min_spacing: float = 0):
+        if self.base is None:
+            self.base = (timestamp, count)
+        if self.size and timestamp - self.times[self._slot(self.size - 1)] < min_spacing:
+            # Слишком частая точка заменяет последнюю, а не вытесняет старые
+            self.counts[self._slot(self.size - 1)] = count
+            self.times[self._slot(self.size - 1)] = timestamp
+            return
+        if self.size < self.capacity:
+            slot = self._slot(self.size)
+            self.size += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[slot] = timestamp
+        self.counts[slot] = count
+
+    def _slot(self, index: int) -> int:
+        return (self.start + index) % self.capacity
+
+    def points(self) -> list:
+        return [(self.times[self._slot(i)], self.counts[self._slot(i)]) for i in range(self.size)]
+
+    @property
+    def last(self):
+        if not self.size:
+            return None
+        slot = self._slot(self.size - 1)
+        return self.times[slot], self.counts[slot]
+
+    @property
+    def growth(self):
+        if self.base is None or not self.size:
+            return None
+        return self.last[1] - self.base[1]
+
+    @property
+    def rate_per_hour(self):
+        if self.base is None or not self.size or self.last[0] <= self.base[0]:
+            return None
+        return self.growth / (self.last[0] - self.base[0]) * 3600
+
+    def sparkline(self, width: int) -> str:
+        counts = [count for _, count in self.points()]
+        if len(counts) < 2:
+            return ""
+        # Сжимаем до width столбиков, беря последнее значение в каждой группе
+        if len(counts) > width:
+            step = len(counts) / width
+            counts = [counts[min(len(counts) - 1, int((i + 1) * step) - 1)] for i in range(width)]
+        low, high = min(counts), max(counts)
+        if high == low:
+            return SPARKLINE_BARS[0] * len(counts)
+        scale = (len(SPARKLINE_BARS) - 1) / (high - low)
+        return "".join(SPARKLINE_BARS[int((count - low) * scale)] for count in counts)
 
-# Хранилища
-active_campaigns = {}
-user_ids = set()
-saved_messages = {}
-user_password_attempts = {}  # user_id -> {'code': str, 'attempts': int}
+def encode_series(series: MemberSeries) -> str:
+    points = series.points()
+    return json.dumps({
+        'capacity': series.capacity,
+        'base': series.base,
+        'times': [t for t, _ in points],
+        'counts': [c for _, c in points],
+    })
+
+def decode_series(raw: str) -> MemberSeries:
+    data = json.loads(raw)
+    series = MemberSeries(data['capacity'])
+    for timestamp, count in zip(data['times'], data['counts']):
+        series.add(timestamp, count)
+    series.base = tuple(data['base']) if data['base'] else None
+    return series
+
+member_history = PersistentDict(storage, 'member_series', encode_series, decode_series)
+
+def record_member_count(chat_id: int, count: int):
+    series = member_history.get(chat_id)
+    if series is None:
+        series = MemberSeries(MEMBER_SERIES_CAPACITY)
+    series.add(int(time.time()), count, MEMBER_SERIES_MIN_SPACING)
+    member_history[chat_id] = series  # присваивание ставит запись в очередь storage
+
+def format_growth(series: MemberSeries) -> str:
+    if series is None or series.growth is None:
+        return "нет данных"
+    text = f"{series.growth:+,}"
+    if series.rate_per_hour is not None:
+        text += f" (~{series.rate_per_hour:,.1f}/ч)"
+    sparkline = series.sparkline(SPARKLINE_WIDTH)
+    if sparkline:
+        text += f" {sparkline}"
+    return text
+
+# === КЭШ ПОДПИСОК ===
+
+class MembershipCache:
+    def __init__(self, max_size: int, positive_ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (user_id, chat_id) -> (subscribed, expires_at)
+
+    def get(self, user_id: int, chat_id: int):
+        key = (user_id, chat_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id: int, chat_id: int, subscribed: bool):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        key = (user_id, chat_id)
+        self._entries[key] = (subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate_chat(self, chat_id: int):
+        for key in [key for key in self._entries if key[1] == chat_id]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+membership_cache = MembershipCache(
+    MEMBERSHIP_CACHE_MAX_SIZE, MEMBERSHIP_CACHE_POSITIVE_TTL, MEMBERSHIP_CACHE_NEGATIVE_TTL
+)
+
+# Индекс подписок из апдейтов chat_member: chat_id -> OrderedDict {user_id: подписан ли}
+membership_index = {}
+
+def lookup_membership_index(user_id: int, chat_id: int):
+    entries = membership_index.get(chat_id)
+    if entries is None:
+        return None
+    subscribed = entries.get(user_id)
+    if subscribed is not None:
+        entries.move_to_end(user_id)
+    return subscribed
+
+def index_membership(user_id: int, chat_id: int, subscribed: bool):
+    entries = membership_index.get(chat_id)
+    if entries is None:
+        entries = membership_index[chat_id] = OrderedDict()
+    entries[user_id] = subscribed
+    entries.move_to_end(user_id)
+    if len(entries) > MEMBERSHIP_INDEX_MAX_PER_CHAT:
+        entries.popitem(last=False)
+
+def invalidate_campaign_membership(chat_id: int = None):
+    if chat_id is None:
+        membership_cache.clear()
+        membership_index.clear()
+        return
+    membership_cache.invalidate_chat(chat_id)
+    membership_index.pop(chat_id, None)
+
+# === КЭШ ДАННЫХ КАНАЛОВ ===
+
+class ChatInfoCache:
+    def __init__(self, info_ttl: float, count_ttl: float):
+        self.info_ttl = info_ttl
+        self.count_ttl = count_ttl
+        self.hits = 0
+        self.misses = 0
+        self._info = {}    # chat_id -> ({'title', 'username'}, expires_at)
+        self._counts = {}  # chat_id -> (members_count, expires_at)
+        self._inflight = {}  # (вид запроса, chat_id) -> asyncio.Task
+
+    async def _fetch_info(self, bot, chat_id: int):
+        chat = await bot.get_chat(chat_id)
+        info = {'title': chat.title, 'username': chat.username}
+        self._info[chat_id] = (info, time.monotonic() + self.info_ttl)
+        return info
+
+    async def _fetch_count(self, bot, chat_id: int):
+        count = await bot.get_chat_member_count(chat_id)
+        self._counts[chat_id] = (count, time.monotonic() + self.count_ttl)
+        return count
+
+    async def _load(self, kind: str, storage: dict, fetch, bot, chat_id: int, force: bool):
+        entry = storage.get(chat_id)
+        if not force and entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        # Одновременные запросы одного канала ждут один и тот же вызов API
+        key = (kind, chat_id)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch(bot, chat_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_info(self, bot, chat_id: int, force: bool = False):
+        return await self._load("info", self._info, self._fetch_info, bot, chat_id, force)
+
+    async def get_members_count(self, bot, chat_id: int, force: bool = False):
+        return await self._load("count", self._counts, self._fetch_count, bot, chat_id, force)
+
+    async def refresh(self, bot, chat_id: int):
+        info, count = await asyncio.gather(
+            self.get_info(bot, chat_id, force=True),
+            self.get_members_count(bot, chat_id, force=True)
+        )
+        return info, count
+
+    def invalidate(self, chat_id: int = None):
+        if chat_id is None:
+            self._info.clear()
+            self._counts.clear()
+            return
+        self._info.pop(chat_id, None)
+        self._counts.pop(chat_id, None)
+
+chat_info_cache = ChatInfoCache(CHAT_INFO_TTL, CHAT_MEMBERS_COUNT_TTL)
+
+async def get_chat_title(context: ContextTypes.DEFAULT_TYPE, chat_id: int, default: str = None):
+    try:
+        info = await chat_info_cache.get_info(context.bot, chat_id)
+        return info['title'] or info['username'] or f"Канал {chat_id}"
+    except Exception as e:
+        logging.warning(f"Не удалось получить данные канала {chat_id}: {e}")
+        return default or f"Канал {chat_id}"
+
+async def get_chat_members_count(context: ContextTypes.DEFAULT_TYPE, chat_id: int, force: bool = False):
+    try:
+        return await chat_info_cache.get_members_count(context.bot, chat_id, force=force)
+    except Exception as e:
+        logging.warning(f"Не удалось получить число участников {chat_id}: {e}")
+        return None
+
+# === ЗДОРОВЬЕ КАНАЛОВ ===
+
+# Ошибки, которые говорят о проблеме с каналом (бота удалили, лишили прав), а не с пользователем
+CHANNEL_ERROR_MARKERS = (
+    "chat not found", "not enough rights", "member list is inaccessible", "bot is not a member",
+    "channel_private", "need administrator rights",
+)
+
+def is_channel_error(error: Exception) -> bool:
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and any(marker in str(error).lower() for marker in CHANNEL_ERROR_MARKERS)
+
+class ChannelHealth:
+    def __init__(self, failure_threshold: int):
+        self.failure_threshold = failure_threshold
+        self.failures = {}  # chat_id -> число ошибок доступа подряд
+        self.broken = {}  # chat_id -> {'since': datetime, 'error': str, 'probe_interval': секунды}
+
+    def is_broken(self, chat_id: int) -> bool:
+        return chat_id in self.broken
+
+    def record_success(self, chat_id: int):
+        self.failures.pop(chat_id, None)
+
+    def record_failure(self, chat_id: int, error: Exception) -> bool:
+        # True — канал только что признан сломанным
+        if chat_id in self.broken:
+            return False
+        self.failures[chat_id] = self.failures.get(chat_id, 0) + 1
+        if self.failures[chat_id] < self.failure_threshold:
+            return False
+        del self.failures[chat_id]
+        self.broken[chat_id] = {
+            'since': datetime.now(), 'error': str(error), 'probe_interval': CHANNEL_PROBE_MIN_INTERVAL
+        }
+        return True
+
+    def restore(self, chat_id: int):
+        self.failures.pop(chat_id, None)
+        return self.broken.pop(chat_id, None) is not None
+
+channel_health = ChannelHealth(CHANNEL_FAILURE_THRESHOLD)
+
+def channel_probe_job_name(chat_id: int) -> str:
+    return f"channel_probe_{chat_id}"
+
+async def notify_admins(bot, text: str):
+    for admin_id in ADMIN_USER_IDS:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text, parse_mode="HTML")
+        except Exception as e:
+            logging.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+async def on_channel_broken(context: ContextTypes.DEFAULT_TYPE, chat_id: int, error: Exception):
+    logging.error(f"Канал {chat_id} исключён из проверки подписки после {CHANNEL_FAILURE_THRESHOLD} ошибок: {error}")
+    invalidate_campaign_membership(chat_id)
+    recent_subscription_checks.clear()
+    data = active_campaigns.get(chat_id, {})
+    context.job_queue.run_once(
+        probe_channel, when=CHANNEL_PROBE_MIN_INTERVAL, data=chat_id, name=channel_probe_job_name(chat_id)
+    )
+    await notify_admins(
+        context.bot,
+        f"⚠️ <b>Бот потерял доступ к каналу</b> <code>{chat_id}</code> {html.escape(data.get('link', ''))}\n\n"
+        f"Ошибка: {html.escape(str(error))}\n\n"
+        "Канал временно исключён из обязательной подписки. Верните боту права администратора — "
+        "проверка включится сама."
+    )
+
+async def probe_channel(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.data
+    state = channel_health.broken.get(chat_id)
+    if state is None:
+        return
+    if chat_id not in active_campaigns:
+        channel_health.restore(chat_id)
+        return
+    try:
+        # Статус самого бота: в канале он должен оставаться администратором
+        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=context.bot.id)
+        healthy = member.status in ("administrator", "creator")
+        error = f"статус бота в канале: {member.status}"
+    except Exception as e:
+        healthy = False
+        error = str(e)
+    if not healthy:
+        state['error'] = error
+        state['probe_interval'] = min(CHANNEL_PROBE_MAX_INTERVAL, state['probe_interval'] * 2)
+        context.job_queue.run_once(
+            probe_channel, when=state['probe_interval'], data=chat_id, name=channel_probe_job_name(chat_id)
+        )
+        return
+    channel_health.restore(chat_id)
+    invalidate_campaign_membership(chat_id)
+    recent_subscription_checks.clear()
+    logging.info(f"Доступ к каналу {chat_id} восстановлен, проверка подписки снова включена")
+    await notify_admins(
+        context.bot,
+        f"✅ Доступ к каналу <code>{chat_id}</code> восстановлен — он снова участвует в проверке подписки."
+    )
+
+# === МЕТРИКИ ===
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попал квантиль: точности корзин для админки хватает
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.started_at = time.time()
+        self.handler_latency = {}  # имя обработчика -> Histogram
+        self.handler_errors = Counter()  # (обработчик, класс ошибки) -> число
+        self.api_latency = {}  # метод Bot API -> Histogram
+        self.api_errors = Counter()  # (метод, класс ошибки) -> число
+        self.throttled = Counter()  # обработчик -> отклонённые антифлудом запросы
+
+    def _histogram(self, table: dict, name: str) -> Histogram:
+        histogram = table.get(name)
+        if histogram is None:
+            histogram = table[name] = Histogram(self.buckets)
+        return histogram
+
+    def observe_handler(self, name: str, elapsed: float, error: BaseException = None):
+        self._histogram(self.handler_latency, name).observe(elapsed)
+        if error is not None:
+            self.handler_errors[(name, type(error).__name__)] += 1
+
+    def observe_api(self, method: str, elapsed: float, error: BaseException = None):
+        self._histogram(self.api_latency, method).observe(elapsed)
+        if error is not None:
+            self.api_errors[(method, type(error).__name__)] += 1
+
+    def cache_stats(self) -> dict:
+        return {
+            'membership': (membership_cache.hits, membership_cache.misses),
+            'chat_info': (chat_info_cache.hits, chat_info_cache.misses),
+            'saved_links': (saved_links.hits, saved_links.misses),
+        }
+
+    def _render_histograms(self, lines: list, metric: str, label: str, table: dict):
+        lines.append(f"# TYPE {metric} histogram")
+        for name, histogram in sorted(table.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum:.6f}')
+            lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+
+    def render(self) -> str:
+        lines = []
+        self._render_histograms(lines, "bot_handler_latency_seconds", "handler", self.handler_latency)
+        lines.append("# TYPE bot_handler_errors_total counter")
+        for (name, error), count in sorted(self.handler_errors.items()):
+            lines.append(f'bot_handler_errors_total{{handler="{name}",error="{error}"}} {count}')
+        lines.append("# TYPE bot_throttled_total counter")
+        for name, count in sorted(self.throttled.items()):
+            lines.append(f'bot_throttled_total{{handler="{name}"}} {count}')
+        self._render_histograms(lines, "bot_api_request_seconds", "method", self.api_latency)
+        lines.append("# TYPE bot_api_errors_total counter")
+        for (method, error), count in sorted(self.api_errors.items()):
+            lines.append(f'bot_api_errors_total{{method="{method}",error="{error}"}} {count}')
+        lines.append("# TYPE bot_cache_requests_total counter")
+        for cache, (hits, misses) in self.cache_stats().items():
+            lines.append(f'bot_cache_requests_total{{cache="{cache}",result="hit"}} {hits}')
+            lines.append(f'bot_cache_requests_total{{cache="{cache}",result="miss"}} {misses}')
+        lines.append("# TYPE bot_users gauge")
+        lines.append(f'bot_users{{state="active"}} {users.active_count}')
+        lines.append(f'bot_users{{state="blocked"}} {users.blocked_count}')
+        lines.append("# TYPE bot_active_campaigns gauge")
+        lines.append(f"bot_active_campaigns {len(active_campaigns)}")
+        lines.append("# TYPE bot_broken_channels gauge")
+        lines.append(f"bot_broken_channels {len(channel_health.broken)}")
+        lines.append("# TYPE bot_start_time_seconds gauge")
+        lines.append(f"bot_start_time_seconds {self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+
+def instrument_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            result = await callback(update, context)
+        except Exception as e:
+            metrics.observe_handler(name, time.perf_counter() - started, e)
+            raise
+        metrics.observe_handler(name, time.perf_counter() - started)
+        return result
+    return wrapper
+
+class MeteredRequest(BaseRequest):
+    # Обёртка над настоящим транспортом: время и ошибки каждого метода Bot API
+    def __init__(self, request: BaseRequest):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def post(self, url: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                   write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                   pool_timeout=BaseRequest.DEFAULT_NONE):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            result = await self._request.post(
+                url, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception as e:
+            metrics.observe_api(method, time.perf_counter() - started, e)
+            raise
+        metrics.observe_api(method, time.perf_counter() - started)
+        return result
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        return await self._request.do_request(
+            url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+            connect_timeout=connect_timeout, pool_timeout=pool_timeout
+        )
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Минимальный HTTP: любой GET получает метрики, тело запроса не читается
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.startswith(b"GET "):
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "405 Method Not Allowed", b""
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+metrics_server = None
+
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    try:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logging.info(f"Метрики: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logging.warning(f"Не удалось поднять сервер метрик на порту {METRICS_PORT}: {e}")
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+def format_metrics_summary(limit: int = 10) -> str:
+    def latency_lines(table: dict) -> list:
+        top = sorted(table.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+        return [
+            f"• <code>{name}</code>: {h.count:,} шт., ср. {h.sum / h.count * 1000:.0f}мс, "
+            f"p95 ≤{h.quantile(0.95) * 1000:.0f}мс"
+            for name, h in top
+        ]
+
+    uptime = format_time_left(time.time() - metrics.started_at)
+    lines = [f"📈 <b>Метрики</b> (с запуска: {uptime})", "", "<b>Обработчики:</b>"]
+    lines += latency_lines(metrics.handler_latency) or ["• нет данных"]
+    lines += ["", "<b>Bot API:</b>"]
+    lines += latency_lines(metrics.api_latency) or ["• нет данных"]
+    errors = metrics.handler_errors + metrics.api_errors
+    if errors:
+        lines += ["", "<b>Ошибки:</b>"]
+        lines += [f"• <code>{name}</code> {error}: {count:,}" for (name, error), count in errors.most_common(limit)]
+    if metrics.throttled:
+        lines += ["", "<b>Антифлуд:</b>"]
+        lines += [f"• <code>{name}</code>: отклонено {count:,}" for name, count in metrics.throttled.most_common()]
+    lines += ["", "<b>Кэши:</b>"]
+    cache_titles = {'membership': "подписки", 'chat_info': "данные каналов", 'saved_links': "ссылки"}
+    for cache, (hits, misses) in metrics.cache_stats().items():
+        total = hits + misses
+        rate = f"{hits / total:.1%}" if total else "—"
+        lines.append(f"• {cache_titles[cache]}: попаданий {rate} ({hits:,} из {total:,})")
+    return "\n".join(lines)
 
 # === ФОРМАТИРОВАНИЕ ТЕКСТА ===
 
@@ -42,6 +1401,60 @@ def format_text_with_code_blocks(text: str) -> str:
             result.append(safe_line)
     return '\n'.join(result)
 
+# === ШАБЛОНЫ ===
+
+# Подстановки в тексте и кнопках рассылок и сохранённых ссылок
+TEMPLATE_FIELD_RE = re.compile(r"\{(first_name|user_id|start_link)\}")
+DEFAULT_FIRST_NAME = "друг"
+# Персональная ссылка на бота: /start r<user_id>
+REFERRAL_CODE_RE = re.compile(r"^r\d+$")
+
+class MessageTemplate:
+    # Текст разбирается один раз, дальше подстановка — склейка готовых кусков
+    def __init__(self, source: str):
+        self.parts = TEMPLATE_FIELD_RE.split(source)  # чётные — готовый текст, нечётные — имена полей
+        self.fields = frozenset(self.parts[1::2])
+        self.static = source if not self.fields else None
+
+    def render(self, values: dict) -> str:
+        if self.static is not None:
+            return self.static
+        parts = self.parts[:]
+        parts[1::2] = [values[field] for field in self.parts[1::2]]
+        return "".join(parts)
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(source: str) -> MessageTemplate:
+    return MessageTemplate(source)
+
+class KeyboardTemplate:
+    # Кнопки со ссылками: подписи и URL — отдельные шаблоны, без полей разметка собирается один раз
+    def __init__(self, markup: dict):
+        self.rows = [
+            [(compile_template(button['text']), compile_template(button.get('url', ''))) for button in row]
+            for row in markup['inline_keyboard']
+        ]
+        self.fields = frozenset().union(*(text.fields | url.fields for row in self.rows for text, url in row))
+        self.static = InlineKeyboardMarkup.de_json(markup, None) if not self.fields else None
+
+    def render(self, plain_values: dict, url_values: dict) -> InlineKeyboardMarkup:
+        if self.static is not None:
+            return self.static
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(text.render(plain_values), url=url.render(url_values)) for text, url in row]
+            for row in self.rows
+        ])
+
+def template_values(user_id: int, first_name: str = None) -> tuple:
+    # Значения для HTML-текста, для подписей кнопок (простой текст) и для URL кнопок
+    name = first_name or DEFAULT_FIRST_NAME
+    plain_values = {
+        'first_name': name, 'user_id': str(user_id), 'start_link': f"https://t.me/{BOT_USERNAME}?start=r{user_id}"
+    }
+    html_values = {**plain_values, 'first_name': html.escape(name, quote=False)}
+    url_values = {**plain_values, 'first_name': urllib.parse.quote(name)}
+    return html_values, plain_values, url_values
+
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
 def parse_duration(param: str):
@@ -70,40 +1483,127 @@ def parse_duration(param: str):
         raise ValueError("Недопустимая единица времени")
     return delta, None
 
-async def get_unsubscribed_channels(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    unsubscribed = []
-    for chat_id in list(active_campaigns.keys()):
+# Один семафор на процесс: иначе 64 одновременных апдейта × каналы забивают пул httpx,
+# и таймаутами заканчиваются уже ответы пользователям
+membership_check_slots = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+
+async def check_channel_membership(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # Возвращает (подписан ли пользователь, время проверки в секундах);
+    # None — ответа нет из-за сети или перегрузки, канал засчитывается без кэширования
+    indexed = lookup_membership_index(user_id, chat_id)
+    if indexed is not None:
+        return indexed, 0.0
+    cached = membership_cache.get(user_id, chat_id)
+    if cached is not None:
+        return cached, 0.0
+    async with membership_check_slots:
+        started = time.perf_counter()
         try:
-            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                unsubscribed.append(chat_id)
-        except BadRequest as e:
-            logging.warning(f"Ошибка проверки {chat_id}: {e}")
-            if "User not found" in str(e) or "chat not found" in str(e):
-                unsubscribed.append(chat_id)
+            member = await asyncio.wait_for(
+                context.bot.get_chat_member(chat_id=chat_id, user_id=user_id),
+                timeout=MEMBERSHIP_CHECK_TIMEOUT
+            )
+            subscribed = member.status in SUBSCRIBED_STATUSES
+            membership_cache.set(user_id, chat_id, subscribed)
+            channel_health.record_success(chat_id)
+        except asyncio.TimeoutError:
+            logging.warning(f"Ошибка проверки {chat_id}: таймаут {MEMBERSHIP_CHECK_TIMEOUT}с")
+            subscribed = None
         except Exception as e:
             logging.warning(f"Ошибка проверки {chat_id}: {e}")
+            if is_channel_error(e):
+                # Пока предохранитель не сработал, пользователь по-прежнему не проходит этот канал
+                subscribed = False
+                if channel_health.record_failure(chat_id, e):
+                    context.application.create_task(on_channel_broken(context, chat_id, e))
+            elif isinstance(e, BadRequest):
+                subscribed = "User not found" not in str(e)
+            elif isinstance(e, NetworkError):
+                # TimedOut и обрывы соединения — сбой на нашей стороне, подписанного пользователя не отсекаем
+                subscribed = None
+            else:
+                subscribed = False
+        return subscribed, time.perf_counter() - started
+
+# Апдейты одного пользователя и так идут по очереди (PerUserUpdateProcessor), поэтому повторные
+# нажатия и /start сразу после меню просто берут только что полученный результат
+recent_subscription_checks = OrderedDict()  # user_id -> (версия кампаний, время, список неподписанных)
+
+async def get_unsubscribed_channels(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    version = active_campaigns.version
+    recent = recent_subscription_checks.get(user_id)
+    if recent is not None and recent[0] == version and time.monotonic() - recent[1] < SUBSCRIPTION_CHECK_REUSE:
+        return list(recent[2])
+    return await run_subscription_check(user_id, context, version)
+
+def cached_unsubscribed_channels(user_id: int):
+    # Ответ без запросов к API: последняя проверка при тех же кампаниях или кэш подписок по всем каналам.
+    # None — если хотя бы по одному каналу ничего не известно
+    recent = recent_subscription_checks.get(user_id)
+    if recent is not None and recent[0] == active_campaigns.version:
+        return list(recent[2])
+    unsubscribed = []
+    for chat_id in active_campaigns:
+        if channel_health.is_broken(chat_id):
+            continue
+        subscribed = lookup_membership_index(user_id, chat_id)
+        if subscribed is None:
+            subscribed = membership_cache.get(user_id, chat_id)
+        if subscribed is None:
+            return None
+        if not subscribed:
             unsubscribed.append(chat_id)
     return unsubscribed
 
+async def run_subscription_check(user_id: int, context: ContextTypes.DEFAULT_TYPE, version: int):
+    # Каналы, куда у бота нет доступа, не проверяются: пользователь всё равно не смог бы их пройти
+    chat_ids = [chat_id for chat_id in active_campaigns if not channel_health.is_broken(chat_id)]
+    if not chat_ids:
+        return []
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(check_channel_membership(chat_id, user_id, context) for chat_id in chat_ids)
+    )
+    # gather сохраняет порядок, поэтому список идёт в порядке active_campaigns
+    unsubscribed = [chat_id for chat_id, (subscribed, _) in zip(chat_ids, results) if subscribed is False]
+    # Тайминги по каналам — только для отладки: строка собирается на каждую проверку,
+    # общую картину дают метрики обработчиков и Bot API
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        timings = ", ".join(f"{chat_id}={elapsed * 1000:.0f}мс" for chat_id, (_, elapsed) in zip(chat_ids, results))
+        logging.debug(
+            f"Проверка подписки {user_id}: {len(chat_ids)} каналов за "
+            f"{(time.perf_counter() - started) * 1000:.0f}мс ({timings})"
+        )
+    if any(subscribed is None for subscribed, _ in results):
+        # Неполный результат не переиспользуем: следующая проверка спросит API заново
+        return unsubscribed
+    recent_subscription_checks[user_id] = (version, time.monotonic(), unsubscribed)
+    recent_subscription_checks.move_to_end(user_id)
+    while len(recent_subscription_checks) > USER_THROTTLE_MAX_USERS:
+        recent_subscription_checks.popitem(last=False)
+    return unsubscribed
+
 async def notify_campaign_ended(context: ContextTypes.DEFAULT_TYPE, chat_id: int, reason: str):
     if chat_id not in active_campaigns:
         return
     data = active_campaigns[chat_id]
     link = data['link']
-    try:
-        chat = await context.bot.get_chat(chat_id)
-        title = chat.title or chat.username or str(chat_id)
-    except:
-        title = "Неизвестный канал"
+    title = await get_chat_title(context, chat_id, default="Неизвестный канал")
     if reason == "limit":
         reason_text = f"достигнут лимит в {data['member_limit']:,} участников"
     else:
         reason_text = "истекло время действия"
-    try:
-        current_members = getattr(chat, 'members_count', "N/A")
-    except:
-        current_members = "N/A"
+    # Прирост берётся из накопленной истории, без запросов к API в момент отчёта
+    series = member_history.get(chat_id)
+    if series is not None and series.growth is not None:
+        growth_text = f"{series.growth:+,} ({series.base[1]:,} → {series.last[1]:,})"
+        if series.rate_per_hour is not None:
+            growth_text += f"\n• Темп: ~{series.rate_per_hour:,.1f} в час"
+        sparkline = series.sparkline(SPARKLINE_WIDTH)
+        if sparkline:
+            growth_text += f"\n• Динамика: {sparkline}"
+    else:
+        growth_text = "N/A"
     start_time = data.get('start_time', datetime.now() - timedelta(hours=1))
     end_time = datetime.now()
     duration = end_time - start_time
@@ -123,42 +1623,121 @@ async def notify_campaign_ended(context: ContextTypes.DEFAULT_TYPE, chat_id: int
         f"• Начало: {start_time.strftime('%d %B %Y, %H:%M')}\n"
         f"• Окончание: {end_time.strftime('%d %B %Y, %H:%M')}\n"
         f"• Длительность: {dur_str.strip()}\n"
-        f"• Участников привлечено: {current_members}\n\n"
+        f"• Участников привлечено: {growth_text}\n\n"
         f"🎯 <b>Причина завершения:</b> {reason_text}\n\n"
         "💬 Спасибо всем, кто подписался!\n"
         "Не отписывайтесь — в канале выходят самые свежие и безопасные скрипты для Roblox!\n\n"
         "🚀 Следите за обновлениями — скоро новые акции!"
     )
-    for admin_id in ADMIN_USER_IDS:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=message,
-                parse_mode="HTML",
-                disable_web_page_preview=False
-            )
-        except Exception as e:
-            logging.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+    await notify_admins(context.bot, message)
+
+# === ПЛАНИРОВЩИК КАМПАНИЙ ===
+
+# Мин-куча (expires_at, chat_id) кампаний с ограничением по времени
+expiry_heap = []
+EXPIRY_JOB_NAME = "campaign_expiry"
+
+# Защищает составные изменения active_campaigns при параллельной обработке апдейтов и задач
+campaigns_lock = asyncio.Lock()
 
-async def cleanup_expired_campaigns(context: ContextTypes.DEFAULT_TYPE):
+async def end_campaign(context: ContextTypes.DEFAULT_TYPE, chat_id: int, reason: str):
+    async with campaigns_lock:
+        # Срок и лимит могут сработать одновременно — уведомляем только один раз
+        if chat_id not in active_campaigns:
+            return
+        # Кампания удаляется только после уведомления: прерванное остановкой повторится после запуска
+        async with inflight_work:
+            await notify_campaign_ended(context, chat_id, reason)
+        del active_campaigns[chat_id]
+        member_history.pop(chat_id, None)
+        invalidate_campaign_membership(chat_id)
+
+def arm_expiry_job(job_queue):
+    for job in job_queue.get_jobs_by_name(EXPIRY_JOB_NAME):
+        job.schedule_removal()
+    if expiry_heap:
+        delay = max(0.0, (expiry_heap[0][0] - datetime.now()).total_seconds())
+        job_queue.run_once(expire_due_campaigns, when=delay, name=EXPIRY_JOB_NAME)
+
+def schedule_campaign_expiry(job_queue, chat_id: int, expires_at: datetime):
+    heapq.heappush(expiry_heap, (expires_at, chat_id))
+    if expiry_heap[0] == (expires_at, chat_id):
+        arm_expiry_job(job_queue)
+
+async def expire_due_campaigns(context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now()
-    to_remove = []
-    for chat_id, data in active_campaigns.items():
-        if data.get('expires_at') and now >= data['expires_at']:
-            await notify_campaign_ended(context, chat_id, "time")
-            to_remove.append(chat_id)
+    while expiry_heap and expiry_heap[0][0] <= now:
+        expires_at, chat_id = heapq.heappop(expiry_heap)
+        data = active_campaigns.get(chat_id)
+        # Кампанию могли удалить или пересоздать с другим сроком
+        if data is None or data.get('expires_at') != expires_at:
             continue
-        if data.get('member_limit'):
-            try:
-                chat = await context.bot.get_chat(chat_id)
-                if hasattr(chat, 'members_count') and chat.members_count >= data['member_limit']:
-                    await notify_campaign_ended(context, chat_id, "limit")
-                    to_remove.append(chat_id)
-            except Exception as e:
-                logging.warning(f"Не удалось проверить участников для {chat_id}: {e}")
-    for cid in to_remove:
-        if cid in active_campaigns:
-            del active_campaigns[cid]
+        # Последняя точка истории, чтобы прирост в отчёте был на момент окончания
+        members_count = await get_chat_members_count(context, chat_id)
+        if members_count is not None:
+            record_member_count(chat_id, members_count)
+        await end_campaign(context, chat_id, "time")
+    arm_expiry_job(context.job_queue)
+
+# chat_id -> {'count', 'sampled_at', 'rate' (участников в секунду), 'eta' (секунд до лимита), 'interval'}
+member_samplers = {}
+
+def sampler_job_name(chat_id: int) -> str:
+    return f"member_sampler_{chat_id}"
+
+def start_member_sampler(job_queue, chat_id: int, delay: float = 0):
+    for job in job_queue.get_jobs_by_name(sampler_job_name(chat_id)):
+        job.schedule_removal()
+    job_queue.run_once(sample_member_count, when=delay, data=chat_id, name=sampler_job_name(chat_id))
+
+def next_sample_interval(sampler: dict, member_limit: int) -> float:
+    # Без роста интервал удваивается до максимума, при росте — доля прогноза до лимита
+    if sampler['rate'] <= 0:
+        sampler['eta'] = None
+        sampler['interval'] = min(MEMBER_SAMPLE_MAX_INTERVAL, sampler['interval'] * 2)
+    else:
+        sampler['eta'] = (member_limit - sampler['count']) / sampler['rate']
+        sampler['interval'] = min(
+            MEMBER_SAMPLE_MAX_INTERVAL, max(MEMBER_SAMPLE_MIN_INTERVAL, sampler['eta'] * MEMBER_SAMPLE_ETA_FRACTION)
+        )
+    return sampler['interval']
+
+async def sample_member_count(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.data
+    data = active_campaigns.get(chat_id)
+    if not data:
+        member_samplers.pop(chat_id, None)
+        return
+    members_count = await get_chat_members_count(context, chat_id, force=True)
+    if members_count is not None:
+        record_member_count(chat_id, members_count)
+    if not data.get('member_limit'):
+        # Без лимита нужна только история — редкий опрос с постоянным шагом
+        start_member_sampler(context.job_queue, chat_id, MEMBER_SERIES_INTERVAL)
+        return
+    sampler = member_samplers.get(chat_id)
+    if members_count is None:
+        delay = next_sample_interval(sampler, data['member_limit']) if sampler else MEMBER_SAMPLE_MIN_INTERVAL
+        start_member_sampler(context.job_queue, chat_id, delay)
+        return
+    now = time.monotonic()
+    if sampler is None:
+        sampler = member_samplers[chat_id] = {
+            'count': members_count, 'sampled_at': now, 'rate': 0.0, 'eta': None,
+            'interval': MEMBER_SAMPLE_MIN_INTERVAL / 2
+        }
+    else:
+        elapsed = now - sampler['sampled_at']
+        if elapsed > 0:
+            rate = max(0.0, (members_count - sampler['count']) / elapsed)
+            sampler['rate'] = MEMBER_SAMPLE_RATE_SMOOTHING * rate + (1 - MEMBER_SAMPLE_RATE_SMOOTHING) * sampler['rate']
+        sampler['count'] = members_count
+        sampler['sampled_at'] = now
+    if members_count >= data['member_limit']:
+        member_samplers.pop(chat_id, None)
+        await end_campaign(context, chat_id, "limit")
+        return
+    start_member_sampler(context.job_queue, chat_id, next_sample_interval(sampler, data['member_limit']))
 
 def parse_message_with_buttons(text: str):
     if "\nBUTTONS:\n" not in text:
@@ -172,99 +1751,244 @@ def parse_message_with_buttons(text: str):
             name, url = line.split(" | ", 1)
             name = name.strip()
             url = url.strip()
-            if name and url.startswith(("http://", "https://", "tg://")):
+            if name and url.startswith(("http://", "https://", "tg://", "{start_link}")):
                 buttons.append([InlineKeyboardButton(name, url=url)])
     return message_text, buttons
 
 # === НОВАЯ ФУНКЦИЯ СТАТУСА ===
 
-async def generate_human_readable_status(context: ContextTypes.DEFAULT_TYPE) -> str:
-    if not active_campaigns:
-        status = "❌ Нет активных локальных проверок подписки."
+def format_time_left(seconds: float) -> str:
+    total_seconds = int(seconds)
+    days = total_seconds // 86400
+    hours = (total_seconds % 86400) // 3600
+    minutes = (total_seconds % 3600) // 60
+    secs = total_seconds % 60
+    parts = []
+    if days: parts.append(f"{days}д")
+    if hours: parts.append(f"{hours}ч")
+    if minutes: parts.append(f"{minutes}м")
+    if total_seconds < 300: parts.append(f"{secs}с")
+    return "".join(parts) if parts else "0с"
+
+def format_campaign_status(chat_id: int, data: dict, title: str, members_count, now: datetime) -> str:
+    link = data['link']
+
+    ended = False
+    reason = ""
+    if data.get('expires_at') and now >= data['expires_at']:
+        ended = True
+        reason = "время действия истекло"
+    elif data.get('member_limit'):
+        if members_count is not None and members_count >= data['member_limit']:
+            ended = True
+            reason = f"достигнут лимит в {data['member_limit']:,} участников"
+
+    limit_str = f"{data['member_limit']:,}" if data.get('member_limit') else "∞"
+    if data.get('expires_at') and not ended:
+        time_str = format_time_left((data['expires_at'] - now).total_seconds())
+    elif data.get('expires_at') and ended:
+        time_str = "0"
     else:
-        status_lines = []
-        now = datetime.now()
-        for chat_id, data in active_campaigns.items():
-            try:
-                chat = await context.bot.get_chat(chat_id)
-                title = chat.title or chat.username or f"Канал {chat_id}"
-            except Exception as e:
-                logging.warning(f"Не удалось получить данные канала {chat_id}: {e}")
-                title = f"Канал {chat_id}"
-            link = data['link']
-
-            ended = False
-            reason = ""
-            if data.get('expires_at') and now >= data['expires_at']:
-                ended = True
-                reason = "время действия истекло"
-            elif data.get('member_limit'):
-                try:
-                    current_count = getattr(chat, 'members_count', 0)
-                    if current_count >= data['member_limit']:
-                        ended = True
-                        reason = f"достигнут лимит в {data['member_limit']:,} участников"
-                except:
-                    pass
-
-            limit_str = f"{data['member_limit']:,}" if data.get('member_limit') else "∞"
-            if data.get('expires_at') and not ended:
-                time_left = data['expires_at'] - now
-                total_seconds = int(time_left.total_seconds())
-                days = total_seconds // 86400
-                hours = (total_seconds % 86400) // 3600
-                minutes = (total_seconds % 3600) // 60
-                secs = total_seconds % 60
-                parts = []
-                if days: parts.append(f"{days}д")
-                if hours: parts.append(f"{hours}ч")
-                if minutes: parts.append(f"{minutes}м")
-                if total_seconds < 300: parts.append(f"{secs}с")
-                time_str = "".join(parts) if parts else "0с"
-            elif data.get('expires_at') and ended:
-                time_str = "0"
-            else:
-                time_str = "∞"
+        time_str = "∞"
 
-            end_time_str = data['expires_at'].strftime('%d %B %Y, %H:%M') if data.get('expires_at') else "никогда"
-            members_str = f"{getattr(chat, 'members_count', '~неизвестно'):,}" if hasattr(chat, 'members_count') else "~неизвестно"
+    end_time_str = data['expires_at'].strftime('%d %B %Y, %H:%M') if data.get('expires_at') else "никогда"
+    members_str = f"{members_count:,}" if members_count is not None else "~неизвестно"
 
-            block = (
-                f"📌 {title} / {link}\n"
-                f"👥 {limit_str} / ⏳ {time_str}\n"
-                f"🕒 {end_time_str}\n"
-                f"👤 {members_str}"
-            )
-            if ended:
-                block += f"\n⚠️ КАМПАНИЯ ЗАВЕРШЕНА ({reason})"
-            status_lines.append(block)
-        status = "\n\n" + "\n\n".join(status_lines) + "\n"
-    return status
+    block = (
+        f"📌 {title} / {link}\n"
+        f"👥 {limit_str} / ⏳ {time_str}\n"
+        f"🕒 {end_time_str}\n"
+        f"👤 {members_str}"
+    )
+    if data.get('member_limit') and not ended:
+        sampler = member_samplers.get(chat_id)
+        if sampler and sampler['eta'] is not None:
+            block += f"\n📈 До лимита: ~{format_time_left(sampler['eta'])}"
+        else:
+            block += "\n📈 До лимита: нет роста"
+    block += f"\n📊 Прирост: {format_growth(member_history.get(chat_id))}"
+    broken = channel_health.broken.get(chat_id)
+    if broken:
+        block += (
+            f"\n🚫 Нет доступа с {broken['since'].strftime('%H:%M')} — канал не проверяется "
+            f"({broken['error']})"
+        )
+    if ended:
+        block += f"\n⚠️ КАМПАНИЯ ЗАВЕРШЕНА ({reason})"
+    return block
+
+async def generate_human_readable_status(context: ContextTypes.DEFAULT_TYPE, page: int = 0) -> tuple:
+    # Возвращает (текст, номер страницы, число страниц); запрашиваются данные только показанных кампаний
+    if not active_campaigns:
+        return "❌ Нет активных локальных проверок подписки.", 0, 1
+    campaigns = list(active_campaigns.items())
+    pages = (len(campaigns) + STATUS_PAGE_SIZE - 1) // STATUS_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    shown = campaigns[page * STATUS_PAGE_SIZE:(page + 1) * STATUS_PAGE_SIZE]
+    lookups = await asyncio.gather(*(
+        asyncio.gather(get_chat_title(context, chat_id), get_chat_members_count(context, chat_id))
+        for chat_id, _ in shown
+    ))
+    now = datetime.now()
+    blocks = [
+        format_campaign_status(chat_id, data, title, members_count, now)
+        for (chat_id, data), (title, members_count) in zip(shown, lookups)
+    ]
+    header = f"📋 Активные проверки: {len(campaigns)} (стр. {page + 1}/{pages})"
+    status = header + "\n\n" + "\n\n".join(blocks)
+    if len(status) > TELEGRAM_MESSAGE_LIMIT:
+        status = status[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+    return status, page, pages
+
+def status_page_keyboard(page: int, pages: int) -> InlineKeyboardMarkup:
+    buttons = []
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"admin_status_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"🔄 {page + 1}/{pages}", callback_data=f"admin_status_{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"admin_status_{page + 1}"))
+        buttons.append(nav)
+    else:
+        buttons.append([InlineKeyboardButton("🔄 Обновить", callback_data="admin_status_0")])
+    buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_back")])
+    return InlineKeyboardMarkup(buttons)
 
 # === ОТПРАВКА СОХРАНЁННОГО СООБЩЕНИЯ ===
 
 async def send_saved_message(update: Update, context: ContextTypes.DEFAULT_TYPE, data: dict):
+    user = update.effective_user
+    html_values, _, _ = template_values(user.id, user.first_name)
+    caption = compile_template(data.get('caption', '')).render(html_values)
     try:
         if data['type'] == 'text':
-            await update.message.reply_text(data['content'], parse_mode="HTML")
+            await update.message.reply_text(compile_template(data['content']).render(html_values), parse_mode="HTML")
         elif data['type'] == 'photo':
-            await update.message.reply_photo(photo=data['content'], caption=data.get('caption', ''), parse_mode="HTML")
+            await update.message.reply_photo(photo=data['content'], caption=caption, parse_mode="HTML")
         elif data['type'] == 'video':
-            await update.message.reply_video(video=data['content'], caption=data.get('caption', ''), parse_mode="HTML")
+            await update.message.reply_video(video=data['content'], caption=caption, parse_mode="HTML")
         elif data['type'] == 'document':
-            await update.message.reply_document(document=data['content'], caption=data.get('caption', ''), parse_mode="HTML")
+            await update.message.reply_document(document=data['content'], caption=caption, parse_mode="HTML")
+        elif data['type'] == 'album':
+            await update.message.reply_media_group(media=build_input_media(data['items'], caption))
     except Exception as e:
         logging.error(f"Ошибка отправки сохранённого сообщения: {e}")
         await update.message.reply_text("❌ Ошибка при отправке контента.")
 
+# === ТЕКСТЫ И КЛАВИАТУРЫ ===
+
+# Неизменные тексты и разметка собираются один раз при импорте
+WELCOME_TEXT = (
+    "👋 Привет, друг!\n\n"
+    "Добро пожаловать в бот от Roblox Scripts — твоего надёжного источника скриптов для Roblox!\n\n"
+    "Что тебя ждёт:\n"
+    "• ⚡️ Топовые скрипты — без вирусов, рекламы и переходников\n"
+    "• 🔒 Ручная проверка — только безопасный и стабильный софт\n"
+    "• ♻️ Ежедневные обновления — всё всегда актуально\n\n"
+    "❗️ Важно: \n"
+    "Все скрипты публикуются только в наших Telegram-каналах. Подписывайся, чтобы не пропустить свежие читы и обновления!\n\n"
+    "• По поводу сотрудничества: @nikitos_ads\n\n"
+    "✅ Играй с умом:\n"
+    "Наслаждайся возможностями, но не нарушай правила Roblox и не забывай о безопасности!"
+)
+SUBSCRIBED_WELCOME_TEXT = "✅ Отлично! Вы подписаны на все каналы!\n\n" + WELCOME_TEXT
+WELCOME_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔥 Наш канал", url="https://t.me/script_f")]])
+SUBSCRIPTION_PROMPT_TEXT = (
+    "❕ | Прежде чем пользоваться ботом, подпишись на указанные каналы ниже!\n\n"
+    "⚠️ Подпишитесь на все каналы\n\n"
+    "❕ Нажмите по кнопкам ниже, затем проверьте подписку."
+)
+PROMPT_KEYBOARD_CACHE_SIZE = 1024
+
+# Клавиатура подписки для каждого набора неподписанных каналов; сбрасывается при смене версии кампаний
+prompt_keyboards = {}
+prompt_keyboards_version = None
+
+def get_prompt_keyboard(unsubscribed: list) -> InlineKeyboardMarkup:
+    global prompt_keyboards_version
+    if prompt_keyboards_version != active_campaigns.version or len(prompt_keyboards) >= PROMPT_KEYBOARD_CACHE_SIZE:
+        prompt_keyboards.clear()
+        prompt_keyboards_version = active_campaigns.version
+    key = tuple(unsubscribed)
+    markup = prompt_keyboards.get(key)
+    if markup is None:
+        # Пока шла проверка, кампанию могли удалить
+        links = [active_campaigns[chat_id]['link'] for chat_id in unsubscribed if chat_id in active_campaigns]
+        buttons = []
+        for i in range(0, len(links), 2):
+            buttons.append([InlineKeyboardButton("🔺 Подписаться", url=link) for link in links[i:i + 2]])
+        buttons.append([InlineKeyboardButton("✅ Проверить подписку", callback_data="check_sub")])
+        markup = prompt_keyboards[key] = InlineKeyboardMarkup(buttons)
+    return markup
+
+async def edit_message_if_changed(message, text: str, reply_markup: InlineKeyboardMarkup = None) -> bool:
+    # Повторное нажатие «Проверить подписку» часто не меняет экран: не тратим вызов API на «message is not modified»
+    if message.text == text and message.reply_markup == reply_markup:
+        return False
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+        return False
+    return True
+
+# === АНТИФЛУД ===
+
+THROTTLED_TEXT = "⏳ Слишком часто! Подождите пару секунд и попробуйте снова."
+
+class UserThrottle:
+    def __init__(self, rate: float, burst: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user_id -> TokenBucket, самые давние — в начале
+        self._warned = set()  # кому уже сказали «слишком часто» в текущей серии отказов
+
+    def allow(self, user_id: int) -> bool:
+        if user_id in ADMIN_USER_IDS:
+            return True
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            # Вытесненный пользователь просто начнёт с полного ведра
+            while len(self._buckets) > self.max_users:
+                evicted, _ = self._buckets.popitem(last=False)
+                self._warned.discard(evicted)
+        else:
+            self._buckets.move_to_end(user_id)
+        if bucket.try_acquire():
+            self._warned.discard(user_id)
+            return True
+        return False
+
+    def should_warn(self, user_id: int) -> bool:
+        if user_id in self._warned:
+            return False
+        self._warned.add(user_id)
+        return True
+
+user_throttle = UserThrottle(USER_THROTTLE_RATE, USER_THROTTLE_BURST, USER_THROTTLE_MAX_USERS)
+
 # === ОБРАБОТЧИКИ ===
 
 async def start_with_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
     user_id = update.effective_user.id
-    user_ids.add(user_id)
-    await cleanup_expired_campaigns(context)
+    users.touch(user_id)
+    if not user_throttle.allow(user_id):
+        metrics.throttled["start_with_code"] += 1
+        # Вместо новой проверки — ответ из кэша; если его нет, предупреждаем один раз за серию
+        unsubscribed = cached_unsubscribed_channels(user_id)
+        if unsubscribed:
+            await update.message.reply_text(SUBSCRIPTION_PROMPT_TEXT, reply_markup=get_prompt_keyboard(unsubscribed))
+        elif unsubscribed is not None and not context.args:
+            await update.message.reply_text(WELCOME_TEXT, reply_markup=WELCOME_MARKUP)
+        elif user_throttle.should_warn(user_id):
+            await update.message.reply_text(THROTTLED_TEXT)
+        return
 
     # Локальная проверка подписки
     unsubscribed = await get_unsubscribed_channels(user_id, context)
@@ -275,11 +1999,16 @@ async def start_with_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обработка кода из ссылки
     if context.args:
         code = context.args[0]
-        if code not in saved_messages:
+        if REFERRAL_CODE_RE.match(code):
+            # Персональная ссылка из рассылки ({start_link}) ведёт на обычный /start без поиска в базе
+            await start(update, context)
+            return
+        link = await saved_links.get(code)
+        if link is None:
             await update.message.reply_text("❌ Неверная или устаревшая ссылка.")
             return
 
-        data = saved_messages[code]
+        data = link['data']
         password = data.get('password')
 
         if password:
@@ -288,6 +2017,7 @@ async def start_with_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 attempts = user_password_attempts[user_id].get('attempts', 0)
                 if entered == password:
                     del user_password_attempts[user_id]
+                    saved_links.register_view(code, link)
                     await send_saved_message(update, context, data)
                     return
                 else:
@@ -306,6 +2036,7 @@ async def start_with_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("🔐 Этот контент защищён паролем.\nВведите пароль:")
                 return
         else:
+            saved_links.register_view(code, link)
             await send_saved_message(update, context, data)
             return
 
@@ -314,59 +2045,26 @@ async def start_with_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
-    await cleanup_expired_campaigns(context)
     await show_subscription_prompt_inplace(update, context)
 
 async def show_subscription_prompt_inplace(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = None):
     if update.effective_chat.type != "private":
         return
     user_id = update.effective_user.id
-    user_ids.add(user_id)
+    users.touch(user_id)
     unsubscribed = await get_unsubscribed_channels(user_id, context)
 
     if not active_campaigns or not unsubscribed:
-        welcome = (
-            "👋 Привет, друг!\n\n"
-            "Добро пожаловать в бот от Roblox Scripts — твоего надёжного источника скриптов для Roblox!\n\n"
-            "Что тебя ждёт:\n"
-            "• ⚡️ Топовые скрипты — без вирусов, рекламы и переходников\n"
-            "• 🔒 Ручная проверка — только безопасный и стабильный софт\n"
-            "• ♻️ Ежедневные обновления — всё всегда актуально\n\n"
-            "❗️ Важно: \n"
-            "Все скрипты публикуются только в наших Telegram-каналах. Подписывайся, чтобы не пропустить свежие читы и обновления!\n\n"
-            "• По поводу сотрудничества: @nikitos_ads\n\n"
-            "✅ Играй с умом:\n"
-            "Наслаждайся возможностями, но не нарушай правила Roblox и не забывай о безопасности!"
-        )
-        keyboard = [[InlineKeyboardButton("🔥 Наш канал", url="https://t.me/script_f")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         if update.callback_query:
-            await update.callback_query.message.edit_text(welcome, reply_markup=reply_markup)
+            await edit_message_if_changed(update.callback_query.message, WELCOME_TEXT, WELCOME_MARKUP)
         else:
-            await update.effective_message.reply_text(welcome, reply_markup=reply_markup)
+            await update.effective_message.reply_text(WELCOME_TEXT, reply_markup=WELCOME_MARKUP)
         return
 
-    buttons = []
-    for i in range(0, len(unsubscribed), 2):
-        row = []
-        if i < len(unsubscribed):
-            chat_id = unsubscribed[i]
-            link = active_campaigns[chat_id]['link']
-            row.append(InlineKeyboardButton("🔺 Подписаться", url=link))
-        if i + 1 < len(unsubscribed):
-            chat_id = unsubscribed[i + 1]
-            link = active_campaigns[chat_id]['link']
-            row.append(InlineKeyboardButton("🔺 Подписаться", url=link))
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("✅ Проверить подписку", callback_data="check_sub")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    text = message_text or (
-        "❕ | Прежде чем пользоваться ботом, подпишись на указанные каналы ниже!\n\n"
-        "⚠️ Подпишитесь на все каналы\n\n"
-        "❕ Нажмите по кнопкам ниже, затем проверьте подписку."
-    )
+    reply_markup = get_prompt_keyboard(unsubscribed)
+    text = message_text or SUBSCRIPTION_PROMPT_TEXT
     if update.callback_query:
-        await update.callback_query.message.edit_text(text, reply_markup=reply_markup)
+        await edit_message_if_changed(update.callback_query.message, text, reply_markup)
     else:
         await update.effective_message.reply_text(text, reply_markup=reply_markup)
 
@@ -374,6 +2072,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
     query = update.callback_query
+    if query.data == "check_sub" and not user_throttle.allow(query.from_user.id):
+        metrics.throttled["button_handler"] += 1
+        await query.answer(THROTTLED_TEXT)
+        return
     await query.answer()
 
     if query.data == "cancel_broadcast":
@@ -390,14 +2092,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = query.from_user.id
         unsubscribed = await get_unsubscribed_channels(user_id, context)
         if unsubscribed:
-            channel_list = ""
-            for chat_id in unsubscribed[:5]:
-                try:
-                    chat = await context.bot.get_chat(chat_id)
-                    title = chat.title or chat.username or f"Канал {chat_id}"
-                    channel_list += f"• {title}\n"
-                except:
-                    channel_list += f"• Канал {chat_id}\n"
+            titles = await asyncio.gather(*(get_chat_title(context, chat_id) for chat_id in unsubscribed[:5]))
+            channel_list = "".join(f"• {title}\n" for title in titles)
             if len(unsubscribed) > 5:
                 channel_list += f"• ... и ещё {len(unsubscribed) - 5} каналов\n"
             await show_subscription_prompt_inplace(
@@ -407,23 +2103,26 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                            f"Пожалуйста, подпишитесь на все каналы и нажмите «Проверить подписку»."
             )
         else:
-            welcome = (
-                "✅ Отлично! Вы подписаны на все каналы!\n\n"
-                "👋 Привет, друг!\n\n"
-                "Добро пожаловать в бот от Roblox Scripts — твоего надёжного источника скриптов для Roblox!\n\n"
-                "Что тебя ждёт:\n"
-                "• ⚡️ Топовые скрипты — без вирусов, рекламы и переходников\n"
-                "• 🔒 Ручная проверка — только безопасный и стабильный софт\n"
-                "• ♻️ Ежедневные обновления — всё всегда актуально\n\n"
-                "❗️ Важно: \n"
-                "Все скрипты публикуются только в наших Telegram-каналах. Подписывайся, чтобы не пропустить свежие читы и обновления!\n\n"
-                "• По поводу сотрудничества: @nikitos_ads\n\n"
-                "✅ Играй с умом:\n"
-                "Наслаждайся возможностями, но не нарушай правила Roblox и не забывай о безопасности!"
-            )
-            keyboard = [[InlineKeyboardButton("🔥 Наш канал", url="https://t.me/script_f")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(welcome, reply_markup=reply_markup)
+            await edit_message_if_changed(query.message, SUBSCRIBED_WELCOME_TEXT, WELCOME_MARKUP)
+
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        users.touch(update.effective_user.id)
+        remember_first_name(update.effective_user.id, update.effective_user.first_name)
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    chat_id = member_update.chat.id
+    if chat_id not in active_campaigns:
+        return
+    user_id = member_update.new_chat_member.user.id
+    # Подписчиков канала, которые никогда не писали боту, проверять не придётся
+    if user_id not in users:
+        return
+    subscribed = member_update.new_chat_member.status in SUBSCRIBED_STATUSES
+    index_membership(user_id, chat_id, subscribed)
+    membership_cache.set(user_id, chat_id, subscribed)
+    recent_subscription_checks.pop(user_id, None)
 
 # === АДМИНКА ===
 
@@ -437,7 +2136,8 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("✅ Добавить проверку", callback_data="admin_setup")],
         [InlineKeyboardButton("🗑 Удалить проверку", callback_data="admin_unsetup")],
         [InlineKeyboardButton("📋 Статус проверок", callback_data="admin_status")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+         InlineKeyboardButton("📈 Метрики", callback_data="admin_metrics")],
         [InlineKeyboardButton("📨 Рассылка", callback_data="admin_broadcast")],
         [InlineKeyboardButton("🔗 Создать ссылку", callback_data="admin_create_link")],
     ]
@@ -471,32 +2171,47 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         buttons.append([InlineKeyboardButton("🗑 Удалить всё", callback_data="del_all")])
         buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_back")])
         await query.edit_message_text("Выберите проверку для удаления:", reply_markup=InlineKeyboardMarkup(buttons))
-    elif data == "admin_status":
-        text = await generate_human_readable_status(context)
-        buttons = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_back")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    elif data == "admin_status" or data.startswith("admin_status_"):
+        requested = int(data.rsplit("_", 1)[1]) if data != "admin_status" else 0
+        text, page, pages = await generate_human_readable_status(context, requested)
+        await edit_message_if_changed(query.message, text, status_page_keyboard(page, pages))
     elif data == "admin_stats":
-        total_users = len(user_ids)
+        total_users = users.active_count
         total_campaigns = len(active_campaigns)
-        total_links = len(saved_messages)
-        protected_links = sum(1 for msg in saved_messages.values() if msg.get('password'))
+        total_links, protected_links = await saved_links.stats()
 
         stats_text = (
             "📊 <b>Статистика бота</b>\n\n"
             f"👥 Всего пользователей: <b>{total_users:,}</b>\n"
+            f"🚫 Заблокировали бота: <b>{users.blocked_count:,}</b>\n"
             f"✅ Активных кампаний: <b>{total_campaigns}</b>\n"
             f"🔗 Сохранённых ссылок: <b>{total_links}</b>\n"
             f"🔒 Защищённых паролем: <b>{protected_links}</b>"
         )
         buttons = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_back")]]
         await query.edit_message_text(stats_text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode="HTML")
+    elif data == "admin_metrics":
+        buttons = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_metrics")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="admin_back")],
+        ]
+        try:
+            await query.edit_message_text(
+                format_metrics_summary(), reply_markup=InlineKeyboardMarkup(buttons), parse_mode="HTML"
+            )
+        except BadRequest as e:
+            # «Обновить» без новых данных — Telegram отвечает «message is not modified»
+            if "not modified" not in str(e):
+                raise
     elif data == "admin_broadcast":
         context.user_data["broadcast_mode"] = True
         keyboard = [[InlineKeyboardButton("✖️ Отменить", callback_data="cancel_broadcast")]]
         await query.edit_message_text(
             "📨 Отправьте сообщение для рассылки (текст, фото, видео и т.д.):\n\n"
             "Можно добавить кнопки в конце:\n\n"
-            "<code>BUTTONS:\nКнопка | https://example.com</code>",
+            "<code>BUTTONS:\nКнопка | https://example.com</code>\n\n"
+            "Подстановки в тексте и кнопках: <code>{first_name}</code>, <code>{user_id}</code>, "
+            "<code>{start_link}</code> — личная ссылка на бота",
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="HTML"
         )
@@ -505,7 +2220,10 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         keyboard = [[InlineKeyboardButton("✖️ Отменить", callback_data="cancel_link")]]
         await query.edit_message_text(
             "📤 Отправьте сообщение (текст, фото, видео и т.д.), из которого нужно создать ссылку:\n\n"
-            "Формат с паролем: <code>#[пароль] текст</code>",
+            "Формат с паролем: <code>#[пароль] текст</code>\n"
+            "Ограничения — отдельной первой строкой: <code>!24h</code> срок жизни, "
+            "<code>!100</code> лимит просмотров (можно вместе: <code>!7d !500</code>)\n"
+            "Подстановки: <code>{first_name}</code>, <code>{user_id}</code>",
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="HTML"
         )
@@ -514,7 +2232,8 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             [InlineKeyboardButton("✅ Добавить проверку", callback_data="admin_setup")],
             [InlineKeyboardButton("🗑 Удалить проверку", callback_data="admin_unsetup")],
             [InlineKeyboardButton("📋 Статус проверок", callback_data="admin_status")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+             InlineKeyboardButton("📈 Метрики", callback_data="admin_metrics")],
             [InlineKeyboardButton("📨 Рассылка", callback_data="admin_broadcast")],
             [InlineKeyboardButton("🔗 Создать ссылку", callback_data="admin_create_link")],
         ]
@@ -528,14 +2247,21 @@ async def handle_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     data = query.data
     if data == "del_all":
-        count = len(active_campaigns)
-        active_campaigns.clear()
+        async with campaigns_lock:
+            count = len(active_campaigns)
+            active_campaigns.clear()
+            member_history.clear()
+            invalidate_campaign_membership()
         await query.edit_message_text(f"✅ Удалено {count} проверок.")
     elif data.startswith("del_"):
         try:
             chat_id = int(data.split("_", 1)[1])
-            if chat_id in active_campaigns:
-                del active_campaigns[chat_id]
+            async with campaigns_lock:
+                removed = active_campaigns.pop(chat_id, None) is not None
+                if removed:
+                    member_history.pop(chat_id, None)
+                    invalidate_campaign_membership(chat_id)
+            if removed:
                 await query.edit_message_text(f"✅ Проверка для {chat_id} удалена.")
             else:
                 await query.edit_message_text("⚠️ Проверка уже удалена.")
@@ -550,9 +2276,6 @@ async def setup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await update.message.reply_text("❌ Используйте: /setup <chat_id> <ссылка> [время/лимит]\nПример: /setup -100123456 https://t.me/channel 30m")
         return
-    if len(active_campaigns) >= MAX_CAMPAIGNS:
-        await update.message.reply_text(f"❌ Достигнут лимит: максимум {MAX_CAMPAIGNS} активных проверок.")
-        return
     try:
         chat_id = int(context.args[0])
         link = context.args[1].strip()
@@ -563,12 +2286,24 @@ async def setup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         expires_at = None
         if delta:
             expires_at = datetime.now() + delta
-        active_campaigns[chat_id] = {
-            'link': link,
-            'expires_at': expires_at,
-            'member_limit': member_limit,
-            'start_time': datetime.now()
-        }
+        async with campaigns_lock:
+            if len(active_campaigns) >= MAX_CAMPAIGNS:
+                await update.message.reply_text(f"❌ Достигнут лимит: максимум {MAX_CAMPAIGNS} активных проверок.")
+                return
+            active_campaigns[chat_id] = {
+                'link': link,
+                'expires_at': expires_at,
+                'member_limit': member_limit,
+                'start_time': datetime.now()
+            }
+            member_history.pop(chat_id, None)
+            channel_health.restore(chat_id)
+            invalidate_campaign_membership(chat_id)
+        if expires_at:
+            schedule_campaign_expiry(context.job_queue, chat_id, expires_at)
+        # Первый замер сразу: от него считается прирост за кампанию
+        member_samplers.pop(chat_id, None)
+        start_member_sampler(context.job_queue, chat_id)
         if not expires_at and not member_limit:
             status = "навсегда"
         elif expires_at:
@@ -580,21 +2315,377 @@ async def setup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}\n\nИспользуйте: /setup <chat_id> <ссылка> [время/лимит]")
 
+# === АЛЬБОМЫ ===
+
+INPUT_MEDIA_TYPES = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+
+# media_group_id -> {'purpose': 'link' | 'broadcast', 'message': первая часть, 'items': [(message_id, тип, file_id)],
+#                    'caption': подпись}
+media_groups = {}
+
+def media_item(message) -> tuple:
+    if message.photo:
+        return 'photo', message.photo[-1].file_id
+    if message.video:
+        return 'video', message.video.file_id
+    if message.document:
+        return 'document', message.document.file_id
+    return None
+
+def build_input_media(items: list, caption: str) -> list:
+    # Подпись альбома Telegram показывает у первого элемента
+    return [
+        INPUT_MEDIA_TYPES[item['type']](
+            media=item['file_id'], caption=caption if i == 0 else None, parse_mode="HTML" if i == 0 else None
+        )
+        for i, item in enumerate(items)
+    ]
+
+def media_group_job_name(media_group_id: str) -> str:
+    return f"media_group_{media_group_id}"
+
+def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE, purpose: str):
+    message = update.message
+    group = media_groups.get(message.media_group_id)
+    if group is None:
+        group = media_groups[message.media_group_id] = {'purpose': purpose, 'message': message, 'items': [], 'caption': ""}
+    item = media_item(message)
+    if item:
+        group['items'].append((message.message_id, *item))
+    if message.caption:
+        group['caption'] = message.caption
+    # Каждая новая часть откладывает сборку альбома
+    name = media_group_job_name(message.media_group_id)
+    for job in context.job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    context.job_queue.run_once(finish_media_group, when=MEDIA_GROUP_DEBOUNCE, data=message.media_group_id, name=name)
+
+def take_media_group_part(update: Update, purpose: str) -> bool:
+    # Продолжение альбома, который уже собирается для этой цели
+    media_group_id = update.message.media_group_id
+    return media_group_id is not None and media_groups.get(media_group_id, {}).get('purpose') == purpose
+
+async def finish_media_group(context: ContextTypes.DEFAULT_TYPE):
+    group = media_groups.pop(context.job.data, None)
+    if group is None:
+        return
+    items = [{'type': item_type, 'file_id': file_id} for _, item_type, file_id in sorted(group['items'])]
+    if not items:
+        await group['message'].reply_text("❌ В альбоме нет поддерживаемых файлов.")
+        return
+    if group['purpose'] == 'link':
+        await create_saved_link(
+            group['message'], group['caption'], lambda body: {'type': 'album', 'items': items, 'caption': body}
+        )
+    else:
+        message_text, buttons = parse_message_with_buttons(format_text_with_code_blocks(group['caption']))
+        if buttons:
+            await group['message'].reply_text("⚠️ Telegram не показывает кнопки под альбомами — они не будут отправлены.")
+        await start_broadcast(context, group['message'], {'type': 'album', 'items': items, 'text': message_text}, [])
+
 # === РАССЫЛКА ===
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, count: float = 1):
+        # Запрос больше ёмкости ведра проходит при полном ведре и уводит его в минус
+        needed = min(count, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class BroadcastRateLimiter:
+    def __init__(self, global_rate: float, per_chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_interval = 1 / per_chat_rate
+        self._chat_next_send = {}  # chat_id -> time.monotonic(), раньше которого в чат не пишем
+
+    async def acquire(self, chat_id: int, count: int = 1):
+        # count — сколько сообщений Telegram засчитает за вызов (альбом — по сообщению на элемент)
+        wait = self._chat_next_send.get(chat_id, 0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.global_bucket.acquire(count)
+        self._chat_next_send[chat_id] = time.monotonic() + self.per_chat_interval * count
+        if len(self._chat_next_send) > 10000:
+            now = time.monotonic()
+            self._chat_next_send = {cid: t for cid, t in self._chat_next_send.items() if t > now}
+
+    def pause(self, seconds: float):
+        self.global_bucket.pause(seconds)
+
+broadcast_limiter = BroadcastRateLimiter(BROADCAST_GLOBAL_RATE, BROADCAST_PER_CHAT_RATE)
+active_broadcasts = {}  # id -> BroadcastJob
+
+class BroadcastJob:
+    def __init__(self, job_id: int, payload: dict, recipients: list, admin_chat_id: int, status_message_id: int,
+                 total: int = None, sent: int = 0, failed: int = 0):
+        self.id = job_id
+        self.payload = payload
+        # Шаблоны собираются один раз на рассылку, на получателя — только подстановка
+        self.template = compile_template(payload['text'])
+        self.keyboard = KeyboardTemplate(payload['reply_markup']) if payload.get('reply_markup') else None
+        self.needs_names = 'first_name' in self.template.fields or bool(
+            self.keyboard and 'first_name' in self.keyboard.fields
+        )
+        self.recipients = recipients
+        self.admin_chat_id = admin_chat_id
+        self.status_message_id = status_message_id
+        self.total = len(recipients) if total is None else total
+        self.sent = sent
+        self.failed = failed
+        self.started_at = time.monotonic()
+        self.started_done = sent + failed
+        self.deliveries = []  # (user_id, статус) ещё не записанные в bot.db
+        self.cancelled = False
+        # Остановка процесса: рассылка замирает на контрольной точке и продолжится после запуска
+        self.suspended = False
+        self.task = None
+        self.running = asyncio.Event()
+        self.running.set()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    def progress_text(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        rate = (self.done - self.started_done) / elapsed if elapsed > 0 else 0
+        remaining = self.total - self.done
+        eta = format_time_left(remaining / rate) if rate > 0 else "—"
+        return (
+            f"📨 Рассылка #{self.id}{' (пауза)' if self.paused else ''}: {self.done:,}/{self.total:,}\n"
+            f"Доставлено: {self.sent}\n"
+            f"Ошибок: {self.failed}\n"
+            f"Скорость: {rate:.1f} сообщ./с\n"
+            f"Осталось: ~{eta}"
+        )
+
+    def render(self, user_id: int, first_name: str = None) -> tuple:
+        html_values, plain_values, url_values = template_values(user_id, first_name)
+        reply_markup = self.keyboard.render(plain_values, url_values) if self.keyboard else None
+        return self.template.render(html_values), reply_markup
+
+    def controls(self) -> InlineKeyboardMarkup:
+        if self.paused:
+            toggle = InlineKeyboardButton("▶️ Продолжить", callback_data=f"bc_resume_{self.id}")
+        else:
+            toggle = InlineKeyboardButton("⏸ Пауза", callback_data=f"bc_pause_{self.id}")
+        return InlineKeyboardMarkup([[toggle, InlineKeyboardButton("✖️ Отменить", callback_data=f"bc_cancel_{self.id}")]])
+
+async def send_broadcast_payload(bot, chat_id: int, payload: dict, text: str,
+                                 reply_markup: InlineKeyboardMarkup = None):
+    if payload['type'] == 'text':
+        await bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode="HTML",
+            reply_markup=reply_markup,
+            disable_web_page_preview=True
+        )
+    elif payload['type'] == 'photo':
+        await bot.send_photo(chat_id=chat_id, photo=payload['file_id'], caption=text,
+                             parse_mode="HTML", reply_markup=reply_markup)
+    elif payload['type'] == 'video':
+        await bot.send_video(chat_id=chat_id, video=payload['file_id'], caption=text,
+                             parse_mode="HTML", reply_markup=reply_markup)
+    elif payload['type'] == 'document':
+        await bot.send_document(chat_id=chat_id, document=payload['file_id'], caption=text,
+                                parse_mode="HTML", reply_markup=reply_markup)
+    elif payload['type'] == 'album':
+        # Весь альбом — один вызов на получателя
+        await bot.send_media_group(chat_id=chat_id, media=build_input_media(payload['items'], text))
+
+async def deliver_broadcast(bot, job: BroadcastJob, user_id: int, first_name: str = None):
+    text, reply_markup = job.render(user_id, first_name)
+    messages = len(job.payload['items']) if job.payload['type'] == 'album' else 1
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        await broadcast_limiter.acquire(user_id, messages)
+        try:
+            await send_broadcast_payload(bot, user_id, job.payload, text, reply_markup)
+            job.sent += 1
+            job.deliveries.append((user_id, RECIPIENT_SENT))
+            return
+        except RetryAfter as e:
+            # Флуд-контроль: останавливаем всю рассылку на указанное время и пробуем снова
+            logging.warning(f"Рассылка {job.id}: RetryAfter {e.retry_after}с")
+            broadcast_limiter.pause(e.retry_after)
+        except Forbidden:
+            users.mark_blocked(user_id)
+            break
+        except Exception as e:
+            logging.warning(f"Рассылка {job.id}: ошибка отправки {user_id}: {e}")
+            break
+    job.failed += 1
+    job.deliveries.append((user_id, RECIPIENT_FAILED))
+
+async def checkpoint_broadcast(job: BroadcastJob):
+    deliveries, job.deliveries = job.deliveries, []
+    try:
+        await asyncio.to_thread(db_checkpoint_broadcast, job.id, deliveries, job.sent, job.failed)
+    except Exception as e:
+        logging.error(f"Рассылка {job.id}: не удалось сохранить прогресс: {e}")
+        job.deliveries = deliveries + job.deliveries
+
+async def update_broadcast_status(bot, job: BroadcastJob, text: str, reply_markup: InlineKeyboardMarkup = None):
+    try:
+        await bot.edit_message_text(
+            chat_id=job.admin_chat_id, message_id=job.status_message_id, text=text, reply_markup=reply_markup
+        )
+    except Exception as e:
+        if "not modified" not in str(e):
+            logging.warning(f"Рассылка {job.id}: не удалось обновить статус: {e}")
+
+async def supervise_broadcast(bot, job: BroadcastJob):
+    last_report = time.monotonic()
+    while True:
+        await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+        if job.deliveries:
+            await checkpoint_broadcast(job)
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await update_broadcast_status(bot, job, job.progress_text(), job.controls())
+
+async def run_broadcast(bot, job: BroadcastJob):
+    job.task = asyncio.current_task()
+    # Получатели идут через очередь: имена для {first_name} подгружаются из базы пачками, а не по одному
+    queue = asyncio.Queue(maxsize=BROADCAST_NAMES_BATCH)
+
+    async def producer():
+        for i in range(0, len(job.recipients), BROADCAST_NAMES_BATCH):
+            chunk = job.recipients[i:i + BROADCAST_NAMES_BATCH]
+            names = await asyncio.to_thread(db_load_first_names, chunk) if job.needs_names else {}
+            for user_id in chunk:
+                await queue.put((user_id, names.get(user_id)))
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            await job.running.wait()
+            if job.cancelled or job.suspended:
+                return
+            await deliver_broadcast(bot, job, *item)
+
+    supervisor = asyncio.create_task(supervise_broadcast(bot, job))
+    feeder = asyncio.create_task(producer())
+    try:
+        async with inflight_work:
+            await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        feeder.cancel()
+        supervisor.cancel()
+        active_broadcasts.pop(job.id, None)
+        await checkpoint_broadcast(job)
+    if job.suspended and not job.cancelled:
+        # Состояние в bot.db остаётся running/paused, недоставленные получатели — pending
+        logging.info(f"Рассылка {job.id} приостановлена на {job.done:,}/{job.total:,} до перезапуска")
+        return
+    if job.cancelled:
+        await asyncio.to_thread(db_set_broadcast_state, job.id, 'cancelled')
+        await update_broadcast_status(
+            bot, job,
+            f"✖️ Рассылка #{job.id} отменена.\n"
+            f"Доставлено: {job.sent}\n"
+            f"Ошибок: {job.failed}"
+        )
+        return
+    await asyncio.to_thread(db_set_broadcast_state, job.id, 'finished')
+    await update_broadcast_status(
+        bot, job,
+        f"✅ Рассылка завершена!\n"
+        f"Доставлено: {job.sent}\n"
+        f"Ошибок: {job.failed}"
+    )
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    application = context.application
+    jobs = await asyncio.to_thread(db_load_unfinished_broadcasts)
+    for data in jobs:
+        job = BroadcastJob(
+            data['id'], data['payload'], data['pending'], data['admin_chat_id'], data['status_message_id'],
+            total=data['total'], sent=data['sent'], failed=data['failed']
+        )
+        if data['state'] == 'paused':
+            job.running.clear()
+        active_broadcasts[job.id] = job
+        logging.info(f"Возобновление рассылки {job.id}: осталось {len(job.recipients)} получателей")
+        await update_broadcast_status(application.bot, job, job.progress_text(), job.controls())
+        application.create_task(run_broadcast(application.bot, job))
+
+async def broadcast_control_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_USER_IDS:
+        await query.answer("❌ Доступ запрещён.")
+        return
+    _, action, job_id = query.data.split("_", 2)
+    job = active_broadcasts.get(int(job_id))
+    if job is None:
+        await query.answer("⚠️ Рассылка уже завершена.")
+        return
+    if action == "pause":
+        job.running.clear()
+        await asyncio.to_thread(db_set_broadcast_state, job.id, 'paused')
+        await query.answer("⏸ Рассылка приостановлена.")
+    elif action == "resume":
+        await asyncio.to_thread(db_set_broadcast_state, job.id, 'running')
+        job.running.set()
+        await query.answer("▶️ Рассылка продолжена.")
+    elif action == "cancel":
+        job.cancelled = True
+        job.running.set()
+        await query.answer("✖️ Рассылка отменяется...")
+        return
+    await update_broadcast_status(context.bot, job, job.progress_text(), job.controls())
+
 async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
     if update.effective_user.id not in ADMIN_USER_IDS:
         return
+    if take_media_group_part(update, 'broadcast'):
+        collect_media_group(update, context, 'broadcast')
+        return
     if not context.user_data.get("broadcast_mode"):
         return
     context.user_data["broadcast_mode"] = False
-    success = 0
-    failed = 0
-    recipients = [uid for uid in user_ids if uid not in ADMIN_USER_IDS]
-    if not recipients:
-        await update.message.reply_text("❌ Нет получателей для рассылки.")
+    if update.message.media_group_id and media_item(update.message):
+        collect_media_group(update, context, 'broadcast')
         return
 
     if update.message.text:
@@ -604,169 +2695,363 @@ async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         formatted_text = format_text_with_code_blocks(raw_text)
         message_text, buttons = parse_message_with_buttons(formatted_text)
-        reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-        for user_id in recipients:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup,
-                    disable_web_page_preview=True
-                )
-                success += 1
-            except Exception as e:
-                failed += 1
-                if "Forbidden" in str(e):
-                    user_ids.discard(user_id)
-
+        payload = {'type': 'text', 'text': message_text}
     elif update.message.photo or update.message.video or update.message.document:
         caption = update.message.caption or ""
         formatted_caption = format_text_with_code_blocks(caption)
         message_text, buttons = parse_message_with_buttons(formatted_caption)
-        reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-        for user_id in recipients:
-            try:
-                if update.message.photo:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=update.message.photo[-1].file_id,
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup
-                    )
-                elif update.message.video:
-                    await context.bot.send_video(
-                        chat_id=user_id,
-                        video=update.message.video.file_id,
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup
-                    )
-                elif update.message.document:
-                    await context.bot.send_document(
-                        chat_id=user_id,
-                        document=update.message.document.file_id,
-                        caption=message_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup
-                    )
-                success += 1
-            except Exception as e:
-                failed += 1
-                if "Forbidden" in str(e):
-                    user_ids.discard(user_id)
+        item_type, file_id = media_item(update.message)
+        payload = {'type': item_type, 'file_id': file_id, 'text': message_text}
     else:
         await update.message.reply_text("❌ Поддерживаются только текст, фото, видео и документы.")
         return
+    await start_broadcast(context, update.message, payload, buttons)
 
-    await update.message.reply_text(
-        f"✅ Рассылка завершена!\n"
-        f"Доставлено: {success}\n"
-        f"Ошибок: {failed}"
+async def start_broadcast(context: ContextTypes.DEFAULT_TYPE, message, payload: dict, buttons: list):
+    recipients = [uid for uid in users.active_ids() if uid not in ADMIN_USER_IDS]
+    if not recipients:
+        await message.reply_text("❌ Нет получателей для рассылки.")
+        return
+    payload['reply_markup'] = InlineKeyboardMarkup(buttons).to_dict() if buttons else None
+
+    status_message = await message.reply_text(f"📨 Рассылка запущена: {len(recipients):,} получателей...")
+    job_id = await asyncio.to_thread(
+        db_create_broadcast, payload, status_message.chat_id, status_message.message_id, recipients
     )
+    job = BroadcastJob(job_id, payload, recipients, status_message.chat_id, status_message.message_id)
+    active_broadcasts[job.id] = job
+    await update_broadcast_status(context.bot, job, job.progress_text(), job.controls())
+    if shutting_down:
+        # Апдейт дорабатывается при остановке — рассылка уже в bot.db и начнётся после перезапуска
+        return
+    # Рассылка идёт в фоне, обработка апдейтов админа не блокируется
+    context.application.create_task(run_broadcast(context.bot, job))
 
 # === СОЗДАНИЕ ССЫЛОК ===
 
+LINK_OPTION_RE = re.compile(r'^!\d+[smhd]?$')
+
+def parse_link_options(text: str) -> tuple:
+    # Первая строка вида «!24h !100» — срок жизни и лимит просмотров ссылки
+    first_line, _, rest = text.partition("\n")
+    tokens = first_line.split()
+    if not tokens or not all(LINK_OPTION_RE.match(token.lower()) for token in tokens):
+        return text, None, None
+    expires_at = None
+    max_views = None
+    for token in tokens:
+        delta, limit = parse_duration(token[1:])
+        if delta:
+            expires_at = time.time() + delta.total_seconds()
+        if limit:
+            max_views = limit
+    return rest.strip(), expires_at, max_views
+
+def parse_link_password(text: str) -> tuple:
+    match = re.match(r'^#$$([^$$]+)$$\s*(.*)', text, re.DOTALL)
+    if match:
+        return match.group(2).strip(), match.group(1).strip()
+    return text, None
+
+async def purge_saved_links(context: ContextTypes.DEFAULT_TYPE):
+    removed = await saved_links.purge()
+    if removed:
+        logging.info(f"Удалено истёкших ссылок: {removed}")
+
 async def create_link_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
     if update.effective_user.id not in ADMIN_USER_IDS:
         return
+    if take_media_group_part(update, 'link'):
+        collect_media_group(update, context, 'link')
+        return
     if not context.user_data.get("create_link_mode"):
         return
     context.user_data["create_link_mode"] = False
+    if update.message.media_group_id and media_item(update.message):
+        collect_media_group(update, context, 'link')
+        return
 
-    length = random.randint(6, 25)
-    safe_chars = string.ascii_letters + string.digits + "-"
-    unique_code = ''.join(random.choices(safe_chars, k=length))
-    while unique_code.startswith(('-', '_')) or unique_code.endswith(('-', '_')):
-        unique_code = ''.join(random.choices(safe_chars, k=length))
+    if update.message.text:
+        make_data = lambda body: {'type': 'text', 'content': format_text_with_code_blocks(body)}
+    elif media_item(update.message):
+        item_type, file_id = media_item(update.message)
+        make_data = lambda body: {'type': item_type, 'content': file_id, 'caption': body}
+    else:
+        await update.message.reply_text("❌ Поддерживаются только текст, фото, видео и документы.")
+        return
+    await create_saved_link(update.message, update.message.text or update.message.caption or "", make_data)
 
-    password = None
-    raw_content = ""
+async def create_saved_link(message, source: str, make_data):
+    try:
+        body, expires_at, max_views = parse_link_options(source)
+    except ValueError as e:
+        await message.reply_text(f"❌ {e}")
+        return
+    body, password = parse_link_password(body)
+    data = make_data(body)
+    data['password'] = password
 
-    if update.message.text:
-        text = update.message.text
-        match = re.match(r'^#$$([^$$]+)$$\s*(.*)', text, re.DOTALL)
-        if match:
-            password = match.group(1).strip()
-            raw_content = match.group(2).strip()
+    unique_code = await saved_links.create(data, expires_at, max_views)
+    link = f"https://t.me/{BOT_USERNAME}?start={unique_code}"
+    limits = ""
+    if expires_at:
+        limits += f"\n⏳ Действует до: {datetime.fromtimestamp(expires_at).strftime('%d.%m.%Y %H:%M')}"
+    if max_views:
+        limits += f"\n👁 Лимит просмотров: {max_views:,}"
+    await message.reply_text(
+        f"✅ Уникальная ссылка создана!\n\n"
+        f"🔗 <code>{link}</code>{limits}",
+        parse_mode="HTML"
+    )
+
+# === ЗАПУСК ===
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются параллельно, одного пользователя — строго по очереди:
+    # на этом держатся флаги broadcast_mode/create_link_mode и ввод пароля
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, число апдейтов в очереди]
+
+    async def process_update(self, update: object, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Сначала очередь пользователя, потом общий лимит — иначе один пользователь
+            # с пачкой апдейтов занял бы все слоты ожиданием своей же блокировки
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    async def do_process_update(self, update: object, coroutine):
+        # Каждый апдейт обрабатывается в своей задаче, поэтому trace id не утекает в соседние
+        if isinstance(update, Update):
+            trace_id_var.set(f"u{update.update_id}")
         else:
-            raw_content = text
+            trace_id_var.set(secrets.token_hex(4))
+        await coroutine
 
-        saved_messages[unique_code] = {
-            'type': 'text',
-            'content': format_text_with_code_blocks(raw_content),
-            'password': password
-        }
+    async def initialize(self):
+        pass
 
-    elif update.message.photo:
-        caption = update.message.caption or ""
-        match = re.match(r'^#$$([^$$]+)$$\s*(.*)', caption, re.DOTALL)
-        if match:
-            password = match.group(1).strip()
-            caption = match.group(2).strip()
-        saved_messages[unique_code] = {
-            'type': 'photo',
-            'content': update.message.photo[-1].file_id,
-            'caption': caption,
-            'password': password
-        }
+    async def shutdown(self):
+        pass
 
-    elif update.message.video:
-        caption = update.message.caption or ""
-        match = re.match(r'^#$$([^$$]+)$$\s*(.*)', caption, re.DOTALL)
-        if match:
-            password = match.group(1).strip()
-            caption = match.group(2).strip()
-        saved_messages[unique_code] = {
-            'type': 'video',
-            'content': update.message.video.file_id,
-            'caption': caption,
-            'password': password
-        }
+class InFlightWork:
+    # Счётчик работы, которую нужно довести до контрольной точки перед остановкой
+    def __init__(self):
+        self.count = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
 
-    elif update.message.document:
-        caption = update.message.caption or ""
-        match = re.match(r'^#$$([^$$]+)$$\s*(.*)', caption, re.DOTALL)
-        if match:
-            password = match.group(1).strip()
-            caption = match.group(2).strip()
-        saved_messages[unique_code] = {
-            'type': 'document',
-            'content': update.message.document.file_id,
-            'caption': caption,
-            'password': password
-        }
+    async def __aenter__(self):
+        self.count += 1
+        self.idle.clear()
 
-    else:
-        await update.message.reply_text("❌ Поддерживаются только текст, фото, видео и документы.")
+    async def __aexit__(self, *exc_info):
+        self.count -= 1
+        if self.count == 0:
+            self.idle.set()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+inflight_work = InFlightWork()
+shutting_down = False
+stop_requested = False
+
+def abort_broadcasts(jobs: list):
+    # Отмена задачи всё равно сохраняет прогресс в finally у run_broadcast
+    for job in jobs:
+        job.suspended = True
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+
+def request_stop(application: Application):
+    # Единственный вызов stop_running(): повторный loop.stop() посреди остановки PTB
+    # обрывает её раньше post_shutdown, и bot.db не сбрасывается
+    global stop_requested
+    if stop_requested:
         return
+    stop_requested = True
+    application.stop_running()
 
-    link = f"https://t.me/{BOT_USERNAME}?start={unique_code}"
-    await update.message.reply_text(
-        f"✅ Уникальная ссылка создана!\n\n"
-        f"🔗 <code>{link}</code>",
-        parse_mode="HTML"
+async def graceful_shutdown(application: Application):
+    global shutting_down
+    shutting_down = True
+    try:
+        # Сигнал мог прийти между post_init и application.start(): тогда stop_running() ничего бы не сделал
+        while not application.running:
+            await asyncio.sleep(0.05)
+        logging.info("Получен сигнал остановки: новые апдейты больше не принимаются")
+        # 1. Новой работы нет: не забираем апдейты и не запускаем новые задачи планировщика
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        application.job_queue.scheduler.pause()
+        # 2. Рассылки дописывают отправляемые сообщения и замирают, уведомления дописываются
+        jobs = list(active_broadcasts.values())
+        for job in jobs:
+            job.suspended = True
+            job.running.set()
+        if not await inflight_work.wait(SHUTDOWN_DRAIN_TIMEOUT):
+            logging.warning(
+                f"За {SHUTDOWN_DRAIN_TIMEOUT:g}с не завершено задач: {inflight_work.count}, прерываем рассылки"
+            )
+            abort_broadcasts(jobs)
+    finally:
+        # 3. Дальше run_polling/run_webhook доделает очередь апдейтов и вызовет on_shutdown со сбросом bot.db
+        if application.running:
+            request_stop(application)
+
+def install_stop_signals(application: Application):
+    loop = asyncio.get_running_loop()
+    state = {'task': None}
+
+    def on_signal():
+        global stop_requested
+        if state['task'] is None:
+            state['task'] = loop.create_task(graceful_shutdown(application))
+            return
+        # Повторный сигнал — не ждём рассылок; остановку доводит тот же graceful_shutdown
+        logging.warning("Повторный сигнал остановки, выходим без ожидания")
+        abort_broadcasts(list(active_broadcasts.values()))
+        state['task'].cancel()
+        if not stop_requested and not application.running:
+            # Запуск ещё не закончился: выходим так же, как обработчик сигналов самого PTB
+            stop_requested = True
+            raise SystemExit
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, on_signal)
+        except NotImplementedError:
+            logging.warning(f"Обработчик {sig.name} не установлен: остановка будет ждать окончания рассылок")
+
+async def load_state(application: Application):
+    def load_all():
+        for container in (active_campaigns, users, user_password_attempts, member_history):
+            container.load()
+        # История кампаний, удалённых до перезапуска
+        for chat_id in [chat_id for chat_id in member_history if chat_id not in active_campaigns]:
+            del member_history[chat_id]
+        return saved_links.count_links()[0]
+    # Ссылки в память не грузятся: их может быть сотни тысяч, читаются по одной по коду
+    total_links = await asyncio.to_thread(load_all)
+    storage.start()
+    logging.info(
+        f"Загружено из bot.db: {len(users)} пользователей, {len(active_campaigns)} кампаний, "
+        f"{total_links} ссылок"
     )
+    for chat_id, data in active_campaigns.items():
+        if data.get('expires_at'):
+            schedule_campaign_expiry(application.job_queue, chat_id, data['expires_at'])
+        start_member_sampler(application.job_queue, chat_id)
+    application.job_queue.run_repeating(purge_saved_links, interval=SAVED_LINKS_PURGE_INTERVAL, first=60)
 
-# === ЗАПУСК ===
+async def on_startup(application: Application):
+    await load_state(application)
+    # post_init выполняется до application.start(): рассылки запускаем первой задачей очереди,
+    # чтобы их задачи учитывались при остановке
+    application.job_queue.run_once(resume_broadcasts, when=0)
+    await start_metrics_server()
 
-def main():
-    TOKEN = "8584027906:AAEZvDcBZw-ugYDOKT6yOurh6vSS5fljpTY"
-    application = Application.builder().token(TOKEN).build()
-    application.add_handler(MessageHandler(filters.ALL, lambda u, c: user_ids.add(u.effective_user.id)), group=-1)
+async def on_shutdown(application: Application):
+    await stop_metrics_server()
+    await asyncio.to_thread(storage.close)
+    try:
+        await asyncio.to_thread(db_checkpoint_wal)
+    except sqlite3.Error as e:
+        logging.warning(f"Не удалось перенести WAL в bot.db: {e}")
+    logging.info("Состояние сохранено, бот остановлен")
+
+async def on_main_startup(application: Application):
+    await on_startup(application)
+    install_stop_signals(application)
+
+def build_application(request=None) -> Application:
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    # Свой BaseRequest подставляют бенчмарки, чтобы не ходить в настоящий Telegram.
+    # Замеряются все вызовы, кроме долгого getUpdates — он только исказил бы гистограммы
+    if request is not None:
+        builder = builder.request(MeteredRequest(request)).get_updates_request(request)
+    else:
+        builder = builder.request(MeteredRequest(
+            HTTPXRequest(connection_pool_size=HTTP_POOL_SIZE, pool_timeout=HTTP_POOL_TIMEOUT)
+        ))
+    application = builder.build()
+    application.add_handler(MessageHandler(filters.ALL, track_user), group=-1)
     application.add_handler(CommandHandler("start", start_with_code))
     application.add_handler(CommandHandler("admin", admin_menu))
     application.add_handler(CommandHandler("setup", setup_command))
     application.add_handler(CallbackQueryHandler(button_handler, pattern="^check_sub$|^cancel_"))
     application.add_handler(CallbackQueryHandler(admin_callback_handler, pattern="^admin_"))
     application.add_handler(CallbackQueryHandler(handle_deletion, pattern=r"^(del_all|del_-?\d+)$"))
+    application.add_handler(CallbackQueryHandler(broadcast_control_handler, pattern=r"^bc_(pause|resume|cancel)_\d+$"))
     application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL, create_link_handler), group=0)
     application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL, broadcast_handler), group=1)
-    print("✅ Бот запущен...")
-    application.run_polling()
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    return application
+
+def resolve_webhook_url() -> str:
+    if WEBHOOK_URL:
+        return WEBHOOK_URL
+    # Telegram принимает только публичный https-адрес; локальный telegram-bot-api достучится и по http
+    api_host = urllib.parse.urlsplit(BOT_API_BASE_URL).hostname
+    if api_host in ("127.0.0.1", "localhost", "::1"):
+        host = "127.0.0.1" if WEBHOOK_LISTEN in ("0.0.0.0", "::") else WEBHOOK_LISTEN
+        return f"http://{host}:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+    raise SystemExit(
+        "❌ BOT_RUN_MODE=webhook требует BOT_WEBHOOK_URL — публичный https-адрес, "
+        "по которому Telegram будет присылать апдейты"
+    )
+
+def main():
+    webhook_url = resolve_webhook_url() if RUN_MODE == "webhook" else None
+    application = build_application()
+    # SIGINT/SIGTERM обрабатывает graceful_shutdown: до application.stop() нужно приостановить рассылки,
+    # иначе stop() ждал бы их полного завершения
+    application.post_init = on_main_startup
+    # chat_member не приходит по умолчанию, его нужно запросить явно
+    if RUN_MODE == "webhook":
+        print(f"✅ Бот запущен (webhook на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            stop_signals=None
+        )
+    else:
+        print("✅ Бот запущен...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+# Поддельный Bot API для бенчмарков и нагрузочных тестов: отвечает как Telegram,
+# но с настраиваемыми задержкой, долей ошибок и RetryAfter
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "EpiLink", "username": "EpiLink_Bot"}
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1, subscribed_rate: float = 1.0,
+                 members_count: int = 1000, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.subscribed_rate = subscribed_rate
+        self.members_count = members_count
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self._message_id = 0
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.errors.clear()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        if "reply_markup" in params:
+            reply_markup = params["reply_markup"]
+            message["reply_markup"] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+        return message
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            # Один и тот же пользователь в одном канале всегда получает один и тот же статус
+            user_id = int(params["user_id"])
+            if user_id == BOT_USER["id"]:
+                # Бот — администратор во всех каналах кампаний
+                rights = (
+                    "can_manage_chat", "can_delete_messages", "can_manage_video_chats", "can_restrict_members",
+                    "can_promote_members", "can_change_info", "can_invite_users",
+                )
+                return {
+                    "status": "administrator", "user": BOT_USER, "can_be_edited": False, "is_anonymous": False,
+                    **{right: True for right in rights},
+                }
+            subscribed = random.Random(user_id * 31 + int(params["chat_id"])).random() < self.subscribed_rate
+            return {
+                "status": "member" if subscribed else "left",
+                "user": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            }
+        if method == "getChat":
+            chat_id = int(params["chat_id"])
+            return {"id": chat_id, "type": "channel", "title": f"Канал {abs(chat_id) % 10000}"}
+        if method == "getChatMemberCount":
+            return self.members_count
+        if method == "getUpdates":
+            return []
+        if method == "sendMediaGroup":
+            return [self._message(params) for _ in params.get("media", [])]
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(params)
+        return True
+
+    async def handle(self, method: str, params: dict):
+        # Возвращает (HTTP-код, тело ответа) так же, как настоящий Bot API
+        self.calls[method] += 1
+        delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        roll = self.random.random() if method != "getMe" else 1.0
+        if roll < self.retry_after_rate:
+            self.errors[(method, "RetryAfter")] += 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        if roll < self.retry_after_rate + self.error_rate:
+            self.errors[(method, "BadRequest")] += 1
+            return 400, json.dumps({"ok": False, "error_code": 400, "description": "Bad Request: simulated error"}).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(method, params)}).encode()
+
+class FakeRequest(BaseRequest):
+    # Подставляется в Application.builder().request(...) вместо HTTPXRequest
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        return await self.api.handle(endpoint, params)
+
+def parse_params(content_type: str, body: bytes, arguments: dict) -> dict:
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    params = {}
+    for name, values in arguments.items():
+        value = values[-1].decode()
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+def make_server_app(api: FakeBotAPI):
+    # HTTP-сервер с тем же API, что и api.telegram.org: /bot<token>/<method>; /stats — счётчики вызовов
+    import tornado.web
+
+    class BotAPIHandler(tornado.web.RequestHandler):
+        def prepare(self):
+            # Без TCP_NODELAY маленькие ответы ждут delayed ACK и задержка растёт на ~40мс
+            self.request.connection.stream.set_nodelay(True)
+
+        async def post(self, token, method):
+            params = parse_params(
+                self.request.headers.get("Content-Type", ""), self.request.body, self.request.body_arguments
+            )
+            status, body = await api.handle(method, params)
+            self.set_status(status)
+            self.set_header("Content-Type", "application/json")
+            self.write(body)
+
+        get = post
+
+    class StatsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps({
+                "calls": dict(api.calls),
+                "errors": {f"{method}:{error}": count for (method, error), count in api.errors.items()},
+            }))
+
+        def delete(self):
+            api.reset_counters()
+
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotAPIHandler), (r"/stats", StatsHandler)])
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Локальный поддельный Bot API сервер")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--subscribed-rate", type=float, default=0.9)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+        retry_after_rate=args.retry_after_rate, subscribed_rate=args.subscribed_rate
+    )
+
+    async def serve():
+        make_server_app(api).listen(args.port, address=args.listen)
+        print(f"Fake Bot API: http://{args.listen}:{args.port}/bot", flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+if __name__ == "__main__":
+    main()
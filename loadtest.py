@@ -0,0 +1,211 @@
+# Нагрузочный тест: прогоняет поток апдейтов (записанный JSONL или синтетический) через настоящий
+# Application из bot.build_application() с заданной скоростью. Bot API — локальный fake_bot_api.py.
+#
+# Примеры:
+#   python loadtest.py
+#   python loadtest.py --rate 5 --count 1500 --users 50000 --campaigns 15
+#   python loadtest.py --updates recorded.jsonl --rate 10 --api-url http://127.0.0.1:8081/bot
+#
+# Потолок самого стенда: fake_bot_api.py — однопоточный tornado, это ~150–200 вызовов/с на свободном
+# ядре и меньше, если бот и сервер делят одно ядро (на одноядерной машине вместе ~90 вызовов/с).
+# Апдейт нового пользователя стоит до (кампаний + 2) вызовов: getChatMember по каждому каналу и ответ,
+# поэтому при 15 кампаниях стенд держит лишь ~5–10 апд./с. Если «вызовы Bot API» в отчёте упираются
+# в этот потолок, а очередь и задержка растут, меряется сервер, а не бот — снижайте --rate или
+# --campaigns либо поднимайте fake_bot_api.py на отдельной машине и передавайте --api-url.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter
+
+import httpx
+
+import bot
+from bench import callback_update, message_update, percentile, setup_campaigns
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import HTTPXRequest
+
+class NoDelayRequest(HTTPXRequest):
+    # Без TCP_NODELAY httpx отправляет заголовки и тело отдельными пакетами, и на локальном
+    # сервере каждый запрос ждёт delayed ACK (~40мс) — это исказило бы замеры.
+    # HTTPXRequest с socket_options создаёт свой транспорт без limits, и httpx молча берёт
+    # пул по умолчанию на 100 соединений — поэтому транспорт собирается здесь с нужным пулом
+    def _build_client(self) -> httpx.AsyncClient:
+        self._client_kwargs["transport"] = httpx.AsyncHTTPTransport(
+            socket_options=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),), limits=self._client_kwargs["limits"]
+        )
+        return super()._build_client()
+
+def synthetic_updates(count: int, users: int, mix: dict, link_codes: list, seed: int = 1):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    for update_id in range(1, count + 1):
+        user_id = 1_000_000 + rng.randrange(users)
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "start":
+            yield message_update(update_id, user_id, "/start")
+        elif kind == "check_sub":
+            yield callback_update(update_id, user_id, "check_sub")
+        else:
+            yield message_update(update_id, user_id, f"/start {rng.choice(link_codes)}")
+
+def recorded_updates(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+def start_fake_api(args) -> tuple:
+    port = args.api_port
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_bot_api.py"),
+            "--port", str(port), "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--error-rate", str(args.error_rate), "--retry-after-rate", str(args.retry_after_rate),
+        ],
+        stdout=subprocess.PIPE, text=True
+    )
+    process.stdout.readline()  # ждём строку о запуске сервера
+    return process, f"http://127.0.0.1:{port}/bot"
+
+def fetch_api_stats(api_url: str) -> dict:
+    stats_url = api_url.rsplit("/bot", 1)[0] + "/stats"
+    with urllib.request.urlopen(stats_url, timeout=5) as response:
+        return json.load(response)
+
+async def run(args, api_url: str):
+    bot.BOT_API_BASE_URL = api_url
+    request = NoDelayRequest(connection_pool_size=args.pool_size, pool_timeout=bot.HTTP_POOL_TIMEOUT)
+    app = bot.build_application(request=request)
+    sent_at = {}
+    latencies = []
+    backlog = []
+    errors = Counter()
+
+    async def mark_done(update: Update, context):
+        started = sent_at.pop(update.update_id, None)
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+
+    async def count_error(update: object, context):
+        errors[type(context.error).__name__] += 1
+
+    # Последняя группа: срабатывает, когда все остальные обработчики апдейта уже отработали
+    app.add_handler(TypeHandler(Update, mark_done), group=1000)
+    app.add_error_handler(count_error)
+    await app.initialize()
+    await bot.on_startup(app)
+    await app.start()
+    setup_campaigns(args.campaigns)
+    link_codes = []
+    for i in range(args.links):
+        code = f"load{i}"
+        bot.saved_links.put(code, {'type': 'text', 'content': f"Ссылка {i}", 'password': None})
+        link_codes.append(code)
+
+    if args.updates:
+        stream = recorded_updates(args.updates)
+    else:
+        stream = synthetic_updates(args.count, args.users, args.mix, link_codes or ["missing"])
+
+    async def sample_backlog():
+        while True:
+            backlog.append((app.update_queue.qsize(), len(sent_at)))
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_backlog())
+    started = time.perf_counter()
+    sent = 0
+    for data in stream:
+        delay = started + sent / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(data, app.bot)
+        sent_at[update.update_id] = time.perf_counter()
+        await app.update_queue.put(update)
+        sent += 1
+    send_elapsed = time.perf_counter() - started
+    deadline = time.perf_counter() + args.drain_timeout
+    while sent_at and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    queue_sizes = [queued for queued, _ in backlog] or [0]
+    in_flight = [pending for _, pending in backlog] or [0]
+    print(f"# апдейтов отправлено: {sent} за {send_elapsed:.1f}с (цель {args.rate}/с)")
+    print(f"обработано:        {len(latencies)} (не дождались: {len(sent_at)})")
+    print(f"пропускная способность: {len(latencies) / elapsed:.1f} апд./с")
+    print(f"очередь update_queue: макс {max(queue_sizes)}, средн {sum(queue_sizes) / len(queue_sizes):.1f}")
+    print(f"в обработке:       макс {max(in_flight)}, средн {sum(in_flight) / len(in_flight):.1f}")
+    print(
+        f"задержка:          p50={percentile(latencies, 50) * 1000:.1f}мс p95={percentile(latencies, 95) * 1000:.1f}мс "
+        f"p99={percentile(latencies, 99) * 1000:.1f}мс max={max(latencies, default=0) * 1000:.1f}мс"
+    )
+    if errors:
+        print(f"ошибки обработчиков: {dict(errors)}")
+
+    # stop() дожидается апдейтов, которые ещё в очереди, поэтому результаты печатаются до него
+    await app.stop()
+    await app.shutdown()
+    await bot.on_shutdown(app)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон апдейтов через Application")
+    parser.add_argument("--updates", help="JSONL с апдейтами Telegram; без него поток синтетический")
+    parser.add_argument("--rate", type=float, default=10, help="апдейтов в секунду")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--campaigns", type=int, default=5)
+    parser.add_argument("--links", type=int, default=100)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("start=0.5,check_sub=0.35,deeplink=0.15"))
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--pool-size", type=int, default=bot.HTTP_POOL_SIZE,
+                        help="размер пула соединений к Bot API (лимиты бота рассчитаны на bot.HTTP_POOL_SIZE)")
+    parser.add_argument("--api-url", help="адрес уже запущенного fake_bot_api.py; без него сервер поднимается сам")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    bot.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "bot.db")
+    bot.METRICS_PORT = 0
+    process = None
+    api_url = args.api_url
+    if not api_url:
+        process, api_url = start_fake_api(args)
+    try:
+        elapsed = asyncio.run(run(args, api_url))
+        stats = fetch_api_stats(api_url)
+        calls = sum(stats['calls'].values())
+        print(f"вызовы Bot API:    {calls} ({calls / elapsed:.0f}/с) {stats['calls']}")
+        if stats["errors"]:
+            print(f"ошибки Bot API:    {stats['errors']}")
+    finally:
+        if process is not None:
+            process.terminate()
+
+if __name__ == "__main__":
+    main()